@@ -1,23 +1,22 @@
 #!/bin/bash
 
-_psql () { psql --set ON_ERROR_STOP=1 "$@" ; }
+# The statements are run by run-postgresql, together with the other setup
+# statements, once all the start hooks are processed.
 
 if [[ ",$postinitdb_actions," = *,simple_db,* ]]; then
-_psql --set=username="$POSTGRESQL_USER" \
-      --set=password="$POSTGRESQL_PASSWORD" \
-<<< "ALTER USER :\"username\" WITH ENCRYPTED PASSWORD :'password';"
+queue_setup_sql "ALTER USER :\"username\" WITH ENCRYPTED PASSWORD :'password';" \
+      username="$POSTGRESQL_USER" \
+      password="$POSTGRESQL_PASSWORD"
 fi
 
 if [ -v POSTGRESQL_MASTER_USER ]; then
-_psql --set=masteruser="$POSTGRESQL_MASTER_USER" \
-      --set=masterpass="$POSTGRESQL_MASTER_PASSWORD" \
-<<'EOF'
-ALTER USER :"masteruser" WITH REPLICATION;
-ALTER USER :"masteruser" WITH ENCRYPTED PASSWORD :'masterpass';
-EOF
+queue_setup_sql "ALTER USER :\"masteruser\" WITH REPLICATION;
+ALTER USER :\"masteruser\" WITH ENCRYPTED PASSWORD :'masterpass';" \
+      masteruser="$POSTGRESQL_MASTER_USER" \
+      masterpass="$POSTGRESQL_MASTER_PASSWORD"
 fi
 
 if [ -v POSTGRESQL_ADMIN_PASSWORD ]; then
-_psql --set=adminpass="$POSTGRESQL_ADMIN_PASSWORD" \
-<<<"ALTER USER \"postgres\" WITH ENCRYPTED PASSWORD :'adminpass';"
+queue_setup_sql "ALTER USER \"postgres\" WITH ENCRYPTED PASSWORD :'adminpass';" \
+      adminpass="$POSTGRESQL_ADMIN_PASSWORD"
 fi
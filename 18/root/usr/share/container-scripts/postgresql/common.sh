@@ -18,13 +18,56 @@ else
     export POSTGRESQL_EFFECTIVE_CACHE_SIZE=${POSTGRESQL_EFFECTIVE_CACHE_SIZE:-$effective_cache}
 fi
 
+# Replication settings (used only with replication enabled).  With the number
+# of replicas declared, there are enough WAL senders for all of them to
+# initialize at once (with WAL streaming, each needs two).
+if [ -n "${POSTGRESQL_REPLICA_COUNT:-}" ]; then
+    max_wal_senders_computed=$((POSTGRESQL_REPLICA_COUNT * 2 + 2))
+    [ "$max_wal_senders_computed" -ge 6 ] || max_wal_senders_computed=6
+    max_replication_slots_computed=$((POSTGRESQL_REPLICA_COUNT + 2))
+    [ "$max_replication_slots_computed" -ge 10 ] || max_replication_slots_computed=10
+fi
+export POSTGRESQL_MAX_WAL_SENDERS=${POSTGRESQL_MAX_WAL_SENDERS:-${max_wal_senders_computed:-6}}
+export POSTGRESQL_MAX_REPLICATION_SLOTS=${POSTGRESQL_MAX_REPLICATION_SLOTS:-${max_replication_slots_computed:-10}}
+export POSTGRESQL_WAL_KEEP_SIZE=${POSTGRESQL_WAL_KEEP_SIZE:-6400}
+export POSTGRESQL_WAL_KEEP_SEGMENTS=$((POSTGRESQL_WAL_KEEP_SIZE / 16))
+export POSTGRESQL_MAX_SLOT_WAL_KEEP_SIZE=${POSTGRESQL_MAX_SLOT_WAL_KEEP_SIZE:-10240}
+
 export POSTGRESQL_LOG_DESTINATION=${POSTGRESQL_LOG_DESTINATION:-}
 
+export POSTGRESQL_RECOVERY_PROGRESS_INTERVAL=${POSTGRESQL_RECOVERY_PROGRESS_INTERVAL:-10}
+
+export POSTGRESQL_ARCHIVE_TIMEOUT=${POSTGRESQL_ARCHIVE_TIMEOUT:-60}
+export POSTGRESQL_BASE_BACKUP_INTERVAL=${POSTGRESQL_BASE_BACKUP_INTERVAL:-24}
+export POSTGRESQL_BASE_BACKUP_RETENTION=${POSTGRESQL_BASE_BACKUP_RETENTION:-2}
+
+export POSTGRESQL_POOLER_PORT=${POSTGRESQL_POOLER_PORT:-6432}
+export POSTGRESQL_POOLER_MODE=${POSTGRESQL_POOLER_MODE:-transaction}
+
 export POSTGRESQL_RECOVERY_FILE=$HOME/openshift-custom-recovery.conf
 export POSTGRESQL_CONFIG_FILE=$HOME/openshift-custom-postgresql.conf
 
 postinitdb_actions=
 
+# The access to $POSTGRESQL_WAL_ARCHIVE, see generate_postgresql_archive_config.
+source "${CONTAINER_SCRIPTS_PATH}/wal-archive.sh"
+
+# Records the finished steps of the data migration, see migrate_db.
+migration_progress_file=$HOME/data/migration-progress
+
+# The checksum of the passwords set by the last start, see have_start_actions.
+passwords_checksum_file=$HOME/data/passwords.sha256
+
+# Set to ':' by try_pgupgrade once the data directory was upgraded.
+pg_upgraded=false
+
+# The wall-clock timings of the startup phases, see startup_phase.  The times
+# are in milliseconds since the epoch.
+startup_timings_file=$HOME/startup-timings.json
+startup_begin_ms=$(date +%s%3N)
+startup_phases=()
+startup_current_phase=
+
 # match . files when moving userdata below
 shopt -s dotglob
 # extglob enables the !(userdata) glob pattern below.
@@ -48,11 +91,50 @@ To migrate data from different PostgreSQL container:
   POSTGRESQL_MIGRATION_ADMIN_PASSWORD (password of remote 'postgres' user)
 And optionally:
   POSTGRESQL_MIGRATION_IGNORE_ERRORS=yes (default is 'no')
+  POSTGRESQL_MIGRATION_MODE=dumpall|parallel|copy (default is 'dumpall')
+  POSTGRESQL_MIGRATION_JOBS (default is the number of CPU cores)
 
 Optional settings:
   POSTGRESQL_MAX_CONNECTIONS (default: 100)
   POSTGRESQL_MAX_PREPARED_TRANSACTIONS (default: 0)
   POSTGRESQL_SHARED_BUFFERS (default: 32MB)
+  POSTGRESQL_TUNING_PROFILE=oltp|olap|mixed|web (default: none)
+  POSTGRESQL_STORAGE_TYPE=auto|hdd|ssd|nvme|network (default: none)
+  POSTGRESQL_REPLICA_COUNT (default: none)
+  POSTGRESQL_REPLICATION_SLOT_NAME (default: none, replicas only)
+  POSTGRESQL_WAL_KEEP_SIZE (default: 6400, in megabytes)
+  POSTGRESQL_SYNC_REPLICAS=N|ANY N (default: none, asynchronous replication)
+  POSTGRESQL_SYNC_REPLICA_NAMES (default: any replica)
+  POSTGRESQL_SYNCHRONOUS_COMMIT (default: on)
+  POSTGRESQL_REPLICA_NAME (default: slot name or hostname, replicas only)
+  POSTGRESQL_MAX_SLOT_WAL_KEEP_SIZE (default: 10240, in megabytes)
+  POSTGRESQL_DEFER_START_HOOKS=true|false (default: false)
+  POSTGRESQL_RECOVERY_PROGRESS_INTERVAL (default: 10, in seconds)
+  POSTGRESQL_RECOVERY_PREFETCH=try|on|off (default: try, PostgreSQL 15+)
+  POSTGRESQL_WAL_DECODE_BUFFER_SIZE (default: 4MB, PostgreSQL 15+)
+  POSTGRESQL_WAL_ARCHIVE (default: none, a directory or an s3:// URL)
+  POSTGRESQL_WAL_ARCHIVE_COMPRESSION=zstd|gzip|none (default: zstd)
+  POSTGRESQL_WAL_ARCHIVE_JOBS (default: 4)
+  POSTGRESQL_WAL_ARCHIVE_S3_ENDPOINT (default: none, AWS)
+  POSTGRESQL_ARCHIVE_TIMEOUT (default: 60, in seconds)
+  POSTGRESQL_BASE_BACKUP_INTERVAL (default: 24, in hours)
+  POSTGRESQL_BASE_BACKUP_RETENTION (default: 2)
+  POSTGRESQL_RESTORE_TARGET_TIME (default: none, a timestamp or 'latest')
+  POSTGRESQL_SEED_FROM (default: none, a base backup directory or a tarball)
+  POSTGRESQL_SEED_VERIFY=true|false (default: true)
+  POSTGRESQL_HUGE_PAGES=on|off|try (default: try if enough huge pages are available)
+  POSTGRESQL_DYNAMIC_SHARED_MEMORY_TYPE (default: posix)
+  POSTGRESQL_CONF_<name> (default: none, any setting, e.g. POSTGRESQL_CONF_work_mem)
+  POSTGRESQL_POOLER=pgbouncer (default: none)
+  POSTGRESQL_POOLER_PORT (default: 6432)
+  POSTGRESQL_POOLER_MODE=transaction|session (default: transaction)
+  POSTGRESQL_POOLER_POOL_SIZE (default: 2 * number of CPU cores + 1)
+  POSTGRESQL_POOLER_MAX_CLIENT_CONN (default: 1000)
+  POSTGRESQL_MAX_WORKER_PROCESSES (default: number of CPU cores, at least 8;
+                                   8 with replication)
+  POSTGRESQL_MAX_PARALLEL_WORKERS (default: number of CPU cores)
+  POSTGRESQL_MAX_PARALLEL_WORKERS_PER_GATHER (default: half of CPU cores, at most 4)
+  POSTGRESQL_MAX_PARALLEL_MAINTENANCE_WORKERS (default: half of CPU cores, at most 4)
 
 For more information see /usr/share/container-scripts/postgresql/README.md
 within the container or visit https://github.com/sclorg/postgresql-container.
@@ -106,6 +188,56 @@ version2number ()
     IFS=$old_IFS
 }
 
+# Print the number of CPU cores the container may use.  This is the number of
+# cores computed by cgroup-limits (or all online CPUs), further limited by the
+# cgroup CPU quota rounded up to whole cores.
+function get_cpu_count() {
+  local cores=${NUMBER_OF_CORES:-$(nproc)} quota= period=
+
+  if [ -r /sys/fs/cgroup/cpu.max ]; then
+    read -r quota period < /sys/fs/cgroup/cpu.max
+  elif [ -r /sys/fs/cgroup/cpu/cpu.cfs_quota_us ]; then
+    quota=$(< /sys/fs/cgroup/cpu/cpu.cfs_quota_us)
+    period=$(< /sys/fs/cgroup/cpu/cpu.cfs_period_us)
+  fi
+
+  # The quota is 'max' (cgroup v2) or -1 (cgroup v1) when not limited.
+  if [[ "$quota" =~ ^[0-9]+$ && "$period" =~ ^[0-9]+$ ]] && [ "$period" -gt 0 ]; then
+    quota=$(( (quota + period - 1) / period ))
+    [ "$quota" -ge "$cores" ] || cores=$quota
+  fi
+  echo "$cores"
+}
+
+# Compute the parallelism settings from the number of CPU cores, so that small
+# containers are not throttled and large ones can use parallel query.  Users
+# can still override these by setting the POSTGRESQL_MAX_WORKER_PROCESSES,
+# POSTGRESQL_MAX_PARALLEL_WORKERS, POSTGRESQL_MAX_PARALLEL_WORKERS_PER_GATHER
+# and POSTGRESQL_MAX_PARALLEL_MAINTENANCE_WORKERS variables.
+function set_parallelism_settings() {
+  local cpus per_query max_workers
+  cpus=$(get_cpu_count)
+
+  # A hot standby requires max_worker_processes to be at least the value used
+  # on the primary, so keep the upstream default with replication unless the
+  # users set it explicitly (to the same value everywhere).
+  max_workers=8
+  if [ "${ENABLE_REPLICATION}" != "true" ] && [ "$cpus" -gt 8 ]; then
+    max_workers=$cpus
+  fi
+  export POSTGRESQL_MAX_WORKER_PROCESSES=${POSTGRESQL_MAX_WORKER_PROCESSES:-$max_workers}
+
+  [ "$cpus" -le "$POSTGRESQL_MAX_WORKER_PROCESSES" ] || cpus=$POSTGRESQL_MAX_WORKER_PROCESSES
+  export POSTGRESQL_MAX_PARALLEL_WORKERS=${POSTGRESQL_MAX_PARALLEL_WORKERS:-$cpus}
+
+  # Use at most half of the cores (and no more than 4) for a single query or
+  # maintenance command, with a single core there is no parallelism at all.
+  per_query=$((cpus / 2))
+  [ "$per_query" -le 4 ] || per_query=4
+  export POSTGRESQL_MAX_PARALLEL_WORKERS_PER_GATHER=${POSTGRESQL_MAX_PARALLEL_WORKERS_PER_GATHER:-$per_query}
+  export POSTGRESQL_MAX_PARALLEL_MAINTENANCE_WORKERS=${POSTGRESQL_MAX_PARALLEL_MAINTENANCE_WORKERS:-$per_query}
+}
+
 # On non-intel arches, data_sync_retry = off does not work
 # Upstream discussion: https://www.postgresql.org/message-id/CA+mCpegfOUph2U4ZADtQT16dfbkjjYNJL1bSTWErsazaFjQW9A@mail.gmail.com
 # Upstream changes that caused this issue:
@@ -128,16 +260,672 @@ function should_hack_data_sync_retry() {
   return 1
 }
 
+# size_to_kb SIZE
+# ---------------
+# Convert a memory size in the postgresql.conf format (e.g. 128MB) to kilobytes.
+# A number without unit is a number of 8kB blocks (the unit of shared_buffers).
+function size_to_kb() {
+  local number=${1%%[!0-9]*}
+  case ${1#$number} in
+    kB) echo "$number" ;;
+    MB) echo "$((number * 1024))" ;;
+    GB) echo "$((number * 1024 * 1024))" ;;
+    TB) echo "$((number * 1024 * 1024 * 1024))" ;;
+    *)  echo "$((number * 8))" ;;
+  esac
+}
+
+# The generated configuration merges the settings of several layers.  A setting
+# of a higher layer replaces the same setting of the lower ones, whatever the
+# order they are set in:
+#
+#   template     the defaults of the image, with the documented variables of
+#                the openshift-custom-*.conf.template files
+#   computed     the values computed for the container, e.g. by the auto-tuning
+#   environment  the POSTGRESQL_* variables overriding or enabling settings
+#   FILE         the postgresql-cfg/*.conf files of the application (and the
+#                files they include), the later ones replacing the earlier
+#   POSTGRESQL_CONF_<name>
+#                the settings of the deployment, see
+#                generate_postgresql_conf_vars_config
+#
+# The merged settings are written to a single flat file, and checked by the
+# server at once before anything else is done with them.
+declare -gA config_values=() config_sources=() config_overridden=()
+config_names=()
+config_notes=()
+last_valid_config_file=$HOME/data/openshift-custom-postgresql.conf.valid
+
+config_layer_rank ()
+{
+  case $1 in
+    template)          echo 1 ;;
+    computed)          echo 2 ;;
+    environment)       echo 3 ;;
+    POSTGRESQL_CONF_*) echo 5 ;;
+    *)                 echo 4 ;;
+  esac
+}
+
+# config_set LAYER NAME VALUE
+# ---------------------------
+# Set the setting NAME to VALUE (in the postgresql.conf syntax, e.g. quoted),
+# unless a higher layer already set it.  The values replaced or ignored are
+# remembered, see write_postgresql_config.
+config_set ()
+{
+  local layer=$1 name=${2,,} value=$3 current
+  current=${config_sources[$name]:-}
+  if [ -z "$current" ]; then
+    config_names+=( "$name" )
+  elif [ "$(config_layer_rank "$layer")" -lt "$(config_layer_rank "$current")" ]; then
+    config_overridden[$name]+="${config_overridden[$name]:+, }$layer: $value"
+    return 0
+  else
+    config_overridden[$name]+="${config_overridden[$name]:+, }$current: ${config_values[$name]}"
+  fi
+  config_values[$name]=$value
+  config_sources[$name]=$layer
+}
+
+# config_set_computed NAME VALUE
+# ------------------------------
+# Set NAME to the computed VALUE, if any, unless the matching upper-case
+# variable (e.g. POSTGRESQL_WORK_MEM) overrides it.
+config_set_computed ()
+{
+  local var=POSTGRESQL_${1^^}
+  [ -z "$2" ] || config_set computed "$1" "$2"
+  [ -z "${!var:-}" ] || config_set environment "$1" "${!var}"
+}
+
+# config_parse LAYER FILE
+# -----------------------
+# Set the settings of the configuration FILE, following its include,
+# include_if_exists and include_dir directives like the server does.  The
+# files of the user layer are named by their path.
+config_parse ()
+{
+  local layer=$1 file=$2 depth=$((${config_depth:-0} + 1)) line n=0 name value path
+  local config_depth=$depth
+  local re="^[[:space:]]*([A-Za-z_][A-Za-z0-9_.]*)[[:space:]]*=?[[:space:]]*('([^'\\\\]|\\\\.|'')*'|[^[:space:]#']+)[[:space:]]*(#.*)?$"
+
+  if [ "$depth" -gt 10 ]; then
+    echo >&2 "=> Could not open $file: maximum nesting depth exceeded"
+    return 1
+  fi
+  while IFS= read -r line || [ -n "$line" ]; do
+    n=$((n + 1))
+    [[ ! $line =~ ^[[:space:]]*(#.*)?$ ]] || continue
+    if [[ ! $line =~ $re ]]; then
+      echo >&2 "=> Syntax error in $file, line $n: $line"
+      return 1
+    fi
+    name=${BASH_REMATCH[1],,}
+    value=${BASH_REMATCH[2]}
+    case $name in
+      include|include_if_exists|include_dir)
+        value=${value#\'}
+        value=${value%\'}
+        [[ $value == /* ]] || value=$(dirname "$file")/$value
+        ;;
+    esac
+    case $name in
+      include_dir)
+        for path in "$value"/*.conf; do
+          [ -f "$path" ] || continue
+          config_parse "$(config_include_layer "$layer" "$path")" "$path" || return 1
+        done
+        ;;
+      include|include_if_exists)
+        if [ ! -f "$value" ] && [ "$name" = include_if_exists ]; then
+          echo "=> Skipping missing configuration file $value"
+          continue
+        fi
+        config_parse "$(config_include_layer "$layer" "$value")" "$value" || return 1
+        ;;
+      *)
+        config_set "$layer" "$name" "$value"
+        ;;
+    esac
+  done < "$file" || {
+    echo >&2 "=> Could not open configuration file $file"
+    return 1
+  }
+}
+
+# The layer of the settings of the FILE included from LAYER.
+config_include_layer ()
+{
+  if [ "$(config_layer_rank "$1")" -lt 4 ]; then
+    echo "$1"
+  else
+    echo "$2"
+  fi
+}
+
+# write_postgresql_config
+# -----------------------
+# Write the merged settings to $POSTGRESQL_CONFIG_FILE, each with the layer it
+# comes from and the values of the other layers it overrides, and check them.
+write_postgresql_config ()
+{
+  local note name
+  {
+    cat <<EOF
+#
+# Custom OpenShift configuration.
+#
+# NOTE: This file is rewritten every time the container is started!
+#       Changes to this file will be overwritten.
+#
+EOF
+    for note in "${config_notes[@]}"; do
+      echo "# $note"
+    done
+    for name in "${config_names[@]}"; do
+      echo
+      echo "# ${config_sources[$name]}${config_overridden[$name]:+, overrides ${config_overridden[$name]}}"
+      echo "$name = ${config_values[$name]}"
+    done
+  } > "${POSTGRESQL_CONFIG_FILE}"
+
+  validate_postgresql_config
+}
+
+# Check $POSTGRESQL_CONFIG_FILE with the server, which reports all the unknown
+# settings and invalid values at once, in a fraction of a second, rather than in
+# pg_ctl start once everything else is done.  'postgres -C' needs a data
+# directory, but does not look into it.  On failure, print the settings which
+# changed since the last valid configuration (or all of them).
+validate_postgresql_config ()
+{
+  local dir output status=0
+  dir=$(mktemp -d) || return 1
+  output=$(postgres -D "$dir" --config-file="${POSTGRESQL_CONFIG_FILE}" -C config_file 2>&1) \
+    || status=$?
+  rm -rf "$dir"
+  if [ "$status" -eq 0 ]; then
+    cp -f "${POSTGRESQL_CONFIG_FILE}" "$last_valid_config_file" 2>/dev/null || :
+    return 0
+  fi
+
+  echo >&2 "$output"
+  echo >&2 "=> Invalid configuration in ${POSTGRESQL_CONFIG_FILE}"
+  if [ -f "$last_valid_config_file" ]; then
+    echo >&2 "=> The settings changed since the last valid configuration:"
+    config_settings_diff "$last_valid_config_file" "${POSTGRESQL_CONFIG_FILE}" >&2
+  else
+    echo >&2 "=> The effective settings:"
+    config_settings_diff /dev/null "${POSTGRESQL_CONFIG_FILE}" >&2
+  fi
+  return 1
+}
+
+# config_settings_diff OLD NEW
+# ----------------------------
+# Print the settings of the configuration file NEW which are not in OLD or have
+# another value there (as '+' lines, with the layer they come from), and those
+# of OLD not in NEW (as '-' lines).
+config_settings_diff ()
+{
+  awk '
+    /^#/ { source = $0; next }
+    !NF { next }
+    FILENAME == ARGV[1] { old[$1] = $0; next }
+    !($1 in old) { print "+ " $0 "    " source; next }
+    old[$1] != $0 { print "- " old[$1]; print "+ " $0 "    " source }
+    { delete old[$1] }
+    END { for (name in old) print "- " old[name] }
+  ' "$1" "$2"
+}
+
+# Compute additional memory, WAL and checkpoint settings for the workload
+# described by $POSTGRESQL_TUNING_PROFILE (oltp, olap, mixed or web).  The
+# formulas are similar to those used by PGTune.  The memory related settings
+# are computed only when the container has a memory limit.  Each setting can be
+# overridden by the corresponding variable (e.g. POSTGRESQL_WORK_MEM), which is
+# used even if no profile is selected.
+function generate_postgresql_tuning_config() {
+  local profile=${POSTGRESQL_TUNING_PROFILE:-}
+  local work_mem= maintenance_work_mem= wal_buffers= min_wal_size= max_wal_size=
+  local checkpoint_completion_target=
+  local memory_kb shared_buffers_kb workers setting
+
+  case $profile in
+    "") ;;
+    web|mixed) min_wal_size=1GB max_wal_size=4GB ;;
+    oltp)      min_wal_size=2GB max_wal_size=8GB ;;
+    olap)      min_wal_size=4GB max_wal_size=16GB ;;
+    *)
+      echo >&2 "Unsupported value: \$POSTGRESQL_TUNING_PROFILE=$profile"
+      return 1
+      ;;
+  esac
+
+  if [ -n "$profile" ]; then
+    checkpoint_completion_target=0.9
+
+    if [[ "${NO_MEMORY_LIMIT:-}" == "true" || -z "${MEMORY_LIMIT_IN_BYTES:-}" ]]; then
+      echo "=> No memory limit set, skipping memory tuning for the '$profile' profile"
+    else
+      memory_kb=$((MEMORY_LIMIT_IN_BYTES / 1024))
+      shared_buffers_kb=$(size_to_kb "$POSTGRESQL_SHARED_BUFFERS")
+
+      # Every connection may run a few sorts or hashes (using work_mem each)
+      # at once, possibly in parallel workers.
+      workers=$POSTGRESQL_MAX_PARALLEL_WORKERS_PER_GATHER
+      [ "$workers" -ge 1 ] || workers=1
+      work_mem=$(( (memory_kb - shared_buffers_kb) / (POSTGRESQL_MAX_CONNECTIONS * 3) / workers ))
+      case $profile in
+        olap|mixed) work_mem=$((work_mem / 2)) ;;
+      esac
+      [ "$work_mem" -ge 64 ] || work_mem=64
+      work_mem=${work_mem}kB
+
+      case $profile in
+        olap) maintenance_work_mem=$((memory_kb / 8)) ;;
+        *)    maintenance_work_mem=$((memory_kb / 16)) ;;
+      esac
+      [ "$maintenance_work_mem" -le 2097152 ] || maintenance_work_mem=2097152
+      maintenance_work_mem=${maintenance_work_mem}kB
+
+      # 3% of shared_buffers, but at most one WAL segment.
+      wal_buffers=$((shared_buffers_kb * 3 / 100))
+      [ "$wal_buffers" -ge 64 ] || wal_buffers=64
+      [ "$wal_buffers" -le 16384 ] || wal_buffers=16384
+      wal_buffers=${wal_buffers}kB
+    fi
+  fi
+
+  [ -z "$profile" ] || config_notes+=( "Auto-tuning profile: $profile" )
+  for setting in work_mem maintenance_work_mem wal_buffers min_wal_size \
+                 max_wal_size checkpoint_completion_target; do
+    config_set_computed "$setting" "${!setting}"
+  done
+}
+
+# Print the sysfs directory of the block device (the whole disk) holding DIR.
+function get_block_device_sysdir() {
+  local device major minor sysdir
+  device=$(stat -c %d "$1" 2>/dev/null) || return 0
+  major=$(( (device >> 8) & 0xfff ))
+  minor=$(( (device & 0xff) | ((device >> 12) & 0xfff00) ))
+  sysdir=$(readlink -f "/sys/dev/block/$major:$minor" 2>/dev/null) || return 0
+  # Partitions have no queue of their own, use the one of the whole disk.
+  [ ! -e "$sysdir/partition" ] || sysdir=${sysdir%/*}
+  echo "$sysdir"
+}
+
+# detect_storage_type DIR
+# -----------------------
+# Print the type of the storage behind DIR: hdd, ssd, nvme or network, or
+# nothing if it can not be detected (e.g. on overlay or tmpfs).
+function detect_storage_type() {
+  local dir=$1 sysdir name
+
+  case $(stat -f -c %T "$dir" 2>/dev/null) in
+    nfs*|smb*|cifs|ceph|glusterfs|fuse*|lustre|gpfs)
+      echo network
+      return
+      ;;
+  esac
+
+  sysdir=$(get_block_device_sysdir "$dir")
+  [ -n "$sysdir" ] && [ -r "$sysdir/queue/rotational" ] || return 0
+
+  name=${sysdir##*/}
+  case $name in
+    nvme*) echo nvme ;;
+    rbd*|nbd*|drbd*) echo network ;;
+    *)
+      if [ "$(< "$sysdir/queue/rotational")" = 1 ]; then
+        echo hdd
+      else
+        echo ssd
+      fi
+      ;;
+  esac
+}
+
+# Print the queue depth of the block device behind DIR, if known.
+function get_storage_queue_depth() {
+  local sysdir
+  sysdir=$(get_block_device_sysdir "$1")
+  [ -z "$sysdir" ] || cat "$sysdir/queue/nr_requests" 2>/dev/null || :
+}
+
+# Set the planner and I/O settings for the storage type in
+# $POSTGRESQL_STORAGE_TYPE (hdd, ssd, nvme or network), or for the storage
+# detected behind the data directory if it is set to 'auto'.  Users can still
+# override them by setting POSTGRESQL_RANDOM_PAGE_COST,
+# POSTGRESQL_EFFECTIVE_IO_CONCURRENCY and POSTGRESQL_MAINTENANCE_IO_CONCURRENCY.
+function generate_postgresql_storage_config() {
+  local storage=${POSTGRESQL_STORAGE_TYPE:-} random_page_cost= io_concurrency=
+  local queue_depth setting
+
+  if [ "$storage" = auto ]; then
+    storage=$(detect_storage_type "$HOME/data")
+    echo "=> Detected storage type of $HOME/data: ${storage:-unknown}"
+  fi
+
+  case $storage in
+    "")      ;;
+    hdd)     random_page_cost=4 io_concurrency=2 ;;
+    ssd)     random_page_cost=1.1 io_concurrency=200 ;;
+    nvme)    random_page_cost=1.1 io_concurrency=500 ;;
+    network) random_page_cost=1.5 io_concurrency=300 ;;
+    *)
+      echo >&2 "Unsupported value: \$POSTGRESQL_STORAGE_TYPE=$storage"
+      return 1
+      ;;
+  esac
+
+  if [ -n "$io_concurrency" ] && [ "${POSTGRESQL_STORAGE_TYPE}" = auto ]; then
+    # There is no point in issuing more requests than the device queues.
+    queue_depth=$(get_storage_queue_depth "$HOME/data")
+    if [[ "$queue_depth" =~ ^[0-9]+$ ]] && [ "$queue_depth" -gt 0 ] \
+        && [ "$queue_depth" -lt "$io_concurrency" ]; then
+      io_concurrency=$queue_depth
+    fi
+  fi
+
+  # Without a storage type, the tuning profile assumes SSD-like storage, which
+  # is what most of the persistent volumes use.
+  if [ -z "$storage" ] && [ -n "${POSTGRESQL_TUNING_PROFILE:-}" ]; then
+    random_page_cost=1.1
+  fi
+
+  local effective_io_concurrency=$io_concurrency
+  local maintenance_io_concurrency=$io_concurrency
+
+  [ -z "$storage" ] || config_notes+=( "Storage type: $storage" )
+  for setting in random_page_cost effective_io_concurrency \
+                 maintenance_io_concurrency; do
+    config_set_computed "$setting" "${!setting}"
+  done
+}
+
+# The WAL replay settings, used by the crash recovery and by the replicas.  The
+# replay prefetches the blocks referenced by the WAL with up to
+# maintenance_io_concurrency concurrent reads (see the storage settings above),
+# looking up to wal_decode_buffer_size ahead.  Without a storage type, the
+# reads are as concurrent as on SSD-like storage, which most of the persistent
+# volumes are; the server default is meant for a single disk.  Users can
+# override them by setting POSTGRESQL_RECOVERY_PREFETCH,
+# POSTGRESQL_WAL_DECODE_BUFFER_SIZE and POSTGRESQL_MAINTENANCE_IO_CONCURRENCY.
+# The settings new in PostgreSQL 15 are hidden from the PostgreSQL 13 server
+# run by pg_upgrade (see disable_unknown_settings).
+function generate_postgresql_wal_replay_config() {
+  if [[ ! "$POSTGRESQL_RECOVERY_PROGRESS_INTERVAL" =~ ^[0-9]+$ ]]; then
+    echo >&2 "Unsupported value: \$POSTGRESQL_RECOVERY_PROGRESS_INTERVAL=$POSTGRESQL_RECOVERY_PROGRESS_INTERVAL"
+    return 1
+  fi
+  local recovery_prefetch=try wal_decode_buffer_size=4MB setting
+
+  config_set_computed log_startup_progress_interval "${POSTGRESQL_RECOVERY_PROGRESS_INTERVAL}s"
+  for setting in recovery_prefetch wal_decode_buffer_size; do
+    config_set_computed "$setting" "${!setting}"
+  done
+  if [ -z "${config_sources[maintenance_io_concurrency]:-}" ]; then
+    config_set computed maintenance_io_concurrency 200
+  fi
+}
+
+# The parallel queries exchange data in dynamic shared memory segments, which
+# are created in /dev/shm by default.  The container engines make it 64MB by
+# default, which large hash joins or sorts may exhaust, so warn about it.
+# Files in the data directory (dynamic_shared_memory_type = mmap) avoid the
+# limit, but write the segments through the data volume, so users have to opt
+# in by setting POSTGRESQL_DYNAMIC_SHARED_MEMORY_TYPE.
+function generate_postgresql_shared_memory_config() {
+  local shm_kb
+  shm_kb=$(df -Pk /dev/shm 2>/dev/null | awk 'NR == 2 { print $2 }')
+  if [ -z "${POSTGRESQL_DYNAMIC_SHARED_MEMORY_TYPE:-}" ] \
+      && [[ "$shm_kb" =~ ^[0-9]+$ ]] && [ "$shm_kb" -lt 262144 ]; then
+    echo "=> WARNING: /dev/shm has only $((shm_kb / 1024)) MB, which large parallel queries" \
+         "may exhaust; mount a larger one, or set POSTGRESQL_DYNAMIC_SHARED_MEMORY_TYPE=mmap"
+  fi
+  config_set_computed dynamic_shared_memory_type ""
+}
+
+# Print the size of the default huge pages in kB, or nothing if the system has
+# no huge pages.
+function get_huge_page_size() {
+  sed -n 's/^Hugepagesize: *\([0-9]*\) kB$/\1/p' /proc/meminfo
+}
+
+# Print the number of the huge pages the container can use: those free in the
+# system and not reserved by other processes yet, but at most what is left
+# below the limit of the hugetlb cgroup.
+function get_available_huge_pages() {
+  local page_kb free reserved limit= usage left dir name
+  page_kb=$(get_huge_page_size)
+  free=$(sed -n 's/^HugePages_Free: *//p' /proc/meminfo)
+  reserved=$(sed -n 's/^HugePages_Rsvd: *//p' /proc/meminfo)
+  if [ -z "$page_kb" ] || [ -z "$free" ]; then
+    echo 0
+    return
+  fi
+  free=$((free - ${reserved:-0}))
+
+  # The cgroup files are named by the page size, e.g. hugetlb.2MB.max.
+  if [ "$page_kb" -ge 1048576 ]; then
+    name=$((page_kb / 1048576))GB
+  else
+    name=$((page_kb / 1024))MB
+  fi
+  if [ -r "/sys/fs/cgroup/hugetlb.$name.max" ]; then
+    limit=$(cat "/sys/fs/cgroup/hugetlb.$name.max")
+    usage=$(cat "/sys/fs/cgroup/hugetlb.$name.current" 2>/dev/null)
+  elif [ -r "/sys/fs/cgroup/hugetlb/hugetlb.$name.limit_in_bytes" ]; then
+    dir=/sys/fs/cgroup/hugetlb
+    limit=$(cat "$dir/hugetlb.$name.limit_in_bytes")
+    usage=$(cat "$dir/hugetlb.$name.usage_in_bytes" 2>/dev/null)
+  fi
+  # cgroup v2 says 'max' when there is no limit.
+  if [[ "$limit" =~ ^[0-9]+$ ]]; then
+    [[ "$usage" =~ ^[0-9]+$ ]] || usage=0
+    left=$(( (limit - usage) / 1024 / page_kb ))
+    [ "$left" -ge "$free" ] || free=$left
+  fi
+  [ "$free" -ge 0 ] || free=0
+  echo "$free"
+}
+
+# Print the number of the huge pages the server needs for its shared memory.
+function get_needed_huge_pages() {
+  # Computed from the configuration and the control file of the cluster.
+  postgres -C shared_memory_size_in_huge_pages 2>/dev/null
+}
+
+# Allocate the shared memory in huge pages if the container can get enough of
+# them, which saves the TLB misses and the page tables of the backends with
+# large shared_buffers.  Otherwise (and with no huge pages at all) use normal
+# pages.  The pages may still be taken by another process before the server
+# starts, so this uses huge_pages = try rather than on, which only
+# POSTGRESQL_HUGE_PAGES=on requires.  Users can override it by setting
+# POSTGRESQL_HUGE_PAGES.  This needs the data directory, so it runs once it
+# exists, and rewrites the generated configuration.
+function configure_huge_pages() {
+  local huge_pages= available needed
+  if [ -z "${POSTGRESQL_HUGE_PAGES:-}" ]; then
+    available=$(get_available_huge_pages)
+    if [ "$available" -eq 0 ]; then
+      huge_pages=off
+    else
+      needed=$(get_needed_huge_pages)
+      if [[ ! "$needed" =~ ^[0-9]+$ ]]; then
+        echo "=> Can not compute the number of the huge pages needed, using huge_pages = try"
+        huge_pages=try
+      elif [ "$needed" -le "$available" ]; then
+        echo "=> Using $needed of the $available available huge pages for the shared memory"
+        huge_pages=try
+      else
+        echo "=> The shared memory needs $needed huge pages, but only $available are" \
+             "available, falling back to normal pages"
+        huge_pages=off
+      fi
+    fi
+  fi
+  config_set_computed huge_pages "$huge_pages"
+  write_postgresql_config
+}
+
+# Set synchronous_standby_names from $POSTGRESQL_SYNC_REPLICAS, which is either
+# the number of the synchronous replicas ("N", the first N connected replicas
+# in the order of $POSTGRESQL_SYNC_REPLICA_NAMES) or "ANY N" (quorum commit,
+# any N of the replicas).  Without the names, any replica can be synchronous.
+function generate_postgresql_sync_replication_config() {
+  local method count names_list names= name
+
+  if [ -n "${POSTGRESQL_SYNC_REPLICAS:-}" ]; then
+    read -r method count <<<"$POSTGRESQL_SYNC_REPLICAS"
+    if [ -z "$count" ]; then
+      count=$method
+      method=FIRST
+    fi
+    method=${method^^}
+    if [[ ! "$method" =~ ^(FIRST|ANY)$ || ! "$count" =~ ^[1-9][0-9]*$ ]]; then
+      echo >&2 "Unsupported value: \$POSTGRESQL_SYNC_REPLICAS=$POSTGRESQL_SYNC_REPLICAS"
+      return 1
+    fi
+
+    names_list=${POSTGRESQL_SYNC_REPLICA_NAMES:-}
+    for name in ${names_list//,/ }; do
+      names+="${names:+, }\"$name\""
+    done
+
+    config_set environment synchronous_standby_names "'$method $count (${names:-*})'"
+  fi
+
+  if [ -n "${POSTGRESQL_SYNCHRONOUS_COMMIT:-}" ]; then
+    config_set environment synchronous_commit "${POSTGRESQL_SYNCHRONOUS_COMMIT}"
+  fi
+}
+
+# Archive the WAL to $POSTGRESQL_WAL_ARCHIVE (see wal-archive.sh), and restore
+# it from there whenever the server is in recovery: when restoring a backup,
+# or when a replica falls too far behind the primary to stream the WAL.
+function generate_postgresql_archive_config() {
+  if [ -n "${POSTGRESQL_RESTORE_TARGET_TIME:-}" ] && [ -z "$wal_archive_url" ]; then
+    echo >&2 "POSTGRESQL_RESTORE_TARGET_TIME requires POSTGRESQL_WAL_ARCHIVE"
+    return 1
+  fi
+  test -n "$wal_archive_url" || return 0
+
+  case $wal_archive_compression in
+    zstd|gzip|none) ;;
+    *)
+      echo >&2 "Unsupported value: \$POSTGRESQL_WAL_ARCHIVE_COMPRESSION=$wal_archive_compression"
+      return 1
+      ;;
+  esac
+  local var
+  for var in POSTGRESQL_WAL_ARCHIVE_JOBS POSTGRESQL_ARCHIVE_TIMEOUT \
+             POSTGRESQL_BASE_BACKUP_INTERVAL POSTGRESQL_BASE_BACKUP_RETENTION; do
+    if [[ ! "${!var:-0}" =~ ^[0-9]+$ ]]; then
+      echo >&2 "Unsupported value: \$$var=${!var}"
+      return 1
+    fi
+  done
+  if [ "$wal_archive_jobs" -lt 1 ] || [ "$POSTGRESQL_BASE_BACKUP_RETENTION" -lt 1 ]; then
+    echo >&2 "POSTGRESQL_WAL_ARCHIVE_JOBS and POSTGRESQL_BASE_BACKUP_RETENTION must be at least 1"
+    return 1
+  fi
+
+  if wal_archive_is_s3; then
+    if ! command -v aws >/dev/null; then
+      echo >&2 "POSTGRESQL_WAL_ARCHIVE=$wal_archive_url requires the 'aws' client, which is not installed"
+      return 1
+    fi
+  elif ! mkdir -p "$wal_archive_url/wal" "$wal_archive_url/basebackups"; then
+    echo >&2 "Can not create the WAL archive in $wal_archive_url"
+    return 1
+  fi
+
+  config_notes+=( "WAL archive: $wal_archive_url" )
+  config_set environment archive_mode on
+  config_set environment archive_command "'/usr/libexec/pg-archive-wal %p %f'"
+  config_set environment archive_timeout "${POSTGRESQL_ARCHIVE_TIMEOUT}"
+  config_set environment restore_command "'/usr/libexec/pg-restore-wal %f %p'"
+  if [ -n "${POSTGRESQL_RESTORE_TARGET_TIME:-}" ] \
+      && [ "$POSTGRESQL_RESTORE_TARGET_TIME" != latest ]; then
+    config_set environment recovery_target_time "'${POSTGRESQL_RESTORE_TARGET_TIME}'"
+    config_set environment recovery_target_action "'promote'"
+  fi
+}
+
+# Set the settings of the POSTGRESQL_CONF_<name> variables, which override any
+# other layer, e.g. POSTGRESQL_CONF_work_mem=64MB (or POSTGRESQL_CONF_WORK_MEM).
+# A double underscore stands for the dot of the settings of the extensions,
+# e.g. POSTGRESQL_CONF_pg_stat_statements__max.  The values of the settings
+# listed by 'postgres --describe-config' are checked against their type here,
+# so that the error names the variable; the unknown names are left to
+# validate_postgresql_config.
+function generate_postgresql_conf_vars_config() {
+  local vars var name value check re expected
+  local -A types=()
+  vars=$(compgen -v POSTGRESQL_CONF_) || return 0
+
+  # Some names are in mixed case, like DateStyle or TimeZone, so match them
+  # in lower case as the variables.
+  while IFS=$'\t' read -r name _ _ value _; do
+    types[${name,,}]=$value
+  done < <(postgres --describe-config 2>/dev/null)
+
+  for var in $vars; do
+    name=${var#POSTGRESQL_CONF_}
+    name=${name,,}
+    name=${name//__/.}
+    value=${!var}
+    check=$value
+    case ${types[$name]:-} in
+      BOOLEAN)
+        check=${value,,}
+        re='^(on|off|true|false|yes|no|1|0)$'
+        expected="a boolean"
+        ;;
+      INTEGER)
+        re='^[-+]?[0-9]+(\.[0-9]+)?[[:space:]]*([kMGT]?B|us|ms|s|min|h|d)?$'
+        expected="an integer, optionally with a unit"
+        ;;
+      REAL)
+        re='^[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?[[:space:]]*(us|ms|s|min|h|d)?$'
+        expected="a number, optionally with a unit"
+        ;;
+      *)
+        re='.*'
+        ;;
+    esac
+    if [[ ! $check =~ $re ]]; then
+      echo >&2 "Unsupported value: \$$var=$value ($expected expected for $name)"
+      return 1
+    fi
+    # Quoted, which the server accepts for any type; the server reads the
+    # backslashes in quoted values as escapes, so double them too.
+    value=${value//\\/\\\\}
+    config_set "$var" "$name" "'${value//\'/\'\'}'"
+  done
+}
+
 function generate_postgresql_libraries_config() {
   if [ -v POSTGRESQL_LIBRARIES ]; then
-    echo "shared_preload_libraries='${POSTGRESQL_LIBRARIES}'" >> "${POSTGRESQL_CONFIG_FILE}"
+    config_set environment shared_preload_libraries "'${POSTGRESQL_LIBRARIES}'"
   fi
 }
 
 
 # New config is generated every time a container is created. It only contains
 # additional custom settings and is included from $PGDATA/postgresql.conf.
+# The settings are merged from the layers described above config_layer_rank.
 function generate_postgresql_config() {
+  local conf
+  set_parallelism_settings
+
+  config_values=() config_sources=() config_overridden=()
+  config_names=() config_notes=()
+
   envsubst \
       < "${CONTAINER_SCRIPTS_PATH}/openshift-custom-postgresql.conf.template" \
       > "${POSTGRESQL_CONFIG_FILE}"
@@ -148,27 +936,39 @@ function generate_postgresql_config() {
         >> "${POSTGRESQL_CONFIG_FILE}"
   fi
 
+  # Rewritten with the other layers by write_postgresql_config below.
+  config_parse template "${POSTGRESQL_CONFIG_FILE}"
+
+  generate_postgresql_sync_replication_config
+  generate_postgresql_archive_config
+
   if should_hack_data_sync_retry ; then
-    echo "data_sync_retry = on" >>"${POSTGRESQL_CONFIG_FILE}"
+    config_set computed data_sync_retry on
   fi
 
   # For easier debugging, allow users to log to stderr (will be visible
   # in the pod logs) using a single variable
   # https://github.com/sclorg/postgresql-container/issues/353
   if [ -n "${POSTGRESQL_LOG_DESTINATION:-}" ] ; then
-    echo "log_destination = 'stderr'" >>"${POSTGRESQL_CONFIG_FILE}"
-    echo "logging_collector = on" >>"${POSTGRESQL_CONFIG_FILE}"
-    echo "log_directory = '$(dirname "${POSTGRESQL_LOG_DESTINATION}")'" >>"${POSTGRESQL_CONFIG_FILE}"
-    echo "log_filename = '$(basename "${POSTGRESQL_LOG_DESTINATION}")'" >>"${POSTGRESQL_CONFIG_FILE}"
+    config_set environment log_destination "'stderr'"
+    config_set environment logging_collector on
+    config_set environment log_directory "'$(dirname "${POSTGRESQL_LOG_DESTINATION}")'"
+    config_set environment log_filename "'$(basename "${POSTGRESQL_LOG_DESTINATION}")'"
   fi
 
+  generate_postgresql_tuning_config
+  generate_postgresql_storage_config
+  generate_postgresql_wal_replay_config
+  generate_postgresql_shared_memory_config
   generate_postgresql_libraries_config
-  (
-  shopt -s nullglob
+
   for conf in "${APP_DATA}"/src/postgresql-cfg/*.conf; do
-    echo include \'${conf}\' >> "${POSTGRESQL_CONFIG_FILE}"
+    [ -f "$conf" ] || continue
+    config_parse "$conf" "$conf" || return 1
   done
-  )
+  generate_postgresql_conf_vars_config
+
+  write_postgresql_config
 }
 
 function generate_postgresql_recovery_config() {
@@ -199,16 +999,29 @@ initdb_wrapper ()
 function initialize_database() {
   initdb_wrapper initdb
 
+  # Progress of a migration into a previous (now removed) data directory.
+  rm -f "$migration_progress_file"
+
+  configure_data_directory
+}
+
+# Add the custom configuration to a new data directory.  The data directories
+# seeded from a backup of this image have it already.
+function configure_data_directory() {
   # PostgreSQL configuration.
-  cat >> "$PGDATA/postgresql.conf" <<EOF
+  if ! grep -qxF "include '${POSTGRESQL_CONFIG_FILE}'" "$PGDATA/postgresql.conf"; then
+    cat >> "$PGDATA/postgresql.conf" <<EOF
 
 # Custom OpenShift configuration:
 include '${POSTGRESQL_CONFIG_FILE}'
 EOF
+  fi
 
   # Access control configuration.
   # FIXME: would be nice-to-have if we could allow connections only from
   #        specific hosts / subnet
+  grep -qF "Custom OpenShift configuration starting at this point" "$PGDATA/pg_hba.conf" \
+    && return 0
   cat >> "$PGDATA/pg_hba.conf" <<EOF
 
 #
@@ -223,23 +1036,153 @@ host replication all all md5
 EOF
 }
 
+# The setup statements queued by queue_setup_sql, and the psql variables they
+# use.  The queue is kept in memory, as it may contain passwords.
+setup_sql=
+setup_sql_vars=()
+
+# queue_setup_sql SQL [NAME=VALUE ...]
+# ------------------------------------
+# Queue the SQL statements to be run by run_setup_sql.  The values, such as
+# names or passwords, should be passed as psql variables NAME (to be used as
+# :"NAME" or :'NAME' in SQL), so they don't need to be quoted.
+queue_setup_sql ()
+{
+  local var
+  setup_sql+="$1"$'\n'
+  shift
+  for var; do
+    setup_sql_vars+=( --set "$var" )
+  done
+}
+
+# Run all the queued setup statements in a single psql session.
+run_setup_sql ()
+{
+  test -n "$setup_sql" || return 0
+  # The setup must not wait for the synchronous standbys, which may not be
+  # connected yet (see run_post_start_job).
+  psql --set ON_ERROR_STOP=1 "${setup_sql_vars[@]}" <<<"SET synchronous_commit = local;
+$setup_sql"
+  setup_sql=
+  setup_sql_vars=()
+}
+
 function create_users() {
   if [[ ",$postinitdb_actions," = *,simple_db,* ]]; then
-    createuser "$POSTGRESQL_USER"
-    createdb --owner="$POSTGRESQL_USER" "$POSTGRESQL_DATABASE"
+    queue_setup_sql 'CREATE ROLE :"username" LOGIN;
+CREATE DATABASE :"database" OWNER :"username";' \
+        username="$POSTGRESQL_USER" database="$POSTGRESQL_DATABASE"
   fi
 
   if [ -v POSTGRESQL_MASTER_USER ]; then
-    createuser "$POSTGRESQL_MASTER_USER"
-    echo "ALTER DATABASE postgres OWNER TO $POSTGRESQL_MASTER_USER;" | psql
-    echo "GRANT ALL PRIVILEGES on DATABASE postgres TO $POSTGRESQL_MASTER_USER;" | psql
+    queue_setup_sql 'CREATE ROLE :"masteruser" LOGIN;
+ALTER DATABASE postgres OWNER TO :"masteruser";
+GRANT ALL PRIVILEGES on DATABASE postgres TO :"masteruser";' \
+        masteruser="$POSTGRESQL_MASTER_USER"
   fi
 }
 
+# Allow the replicas to resynchronize with pg_rewind after a failover.  It
+# connects to the primary as the replication user, which needs to read the
+# data files.  This is idempotent, and run on every start of the primary so
+# that it applies to existing clusters too.
+function grant_rewind_privileges() {
+  if [ "${ENABLE_REPLICATION}" != "true" ] || [ ! -v POSTGRESQL_MASTER_USER ]; then
+    return 0
+  fi
+
+  queue_setup_sql 'GRANT EXECUTE ON FUNCTION pg_catalog.pg_ls_dir(text, boolean, boolean) TO :"masteruser";
+GRANT EXECUTE ON FUNCTION pg_catalog.pg_stat_file(text, boolean) TO :"masteruser";
+GRANT EXECUTE ON FUNCTION pg_catalog.pg_read_binary_file(text) TO :"masteruser";
+GRANT EXECUTE ON FUNCTION pg_catalog.pg_read_binary_file(text, bigint, bigint, boolean) TO :"masteruser";' \
+      masteruser="$POSTGRESQL_MASTER_USER"
+}
+
+# migration_remote CMD [ARG ...]
+# ------------------------------
+# Run the PostgreSQL client CMD against the remote (migrated) cluster.
+migration_remote ()
+{
+    local cmd=$1
+    shift
+    PGPASSWORD="$POSTGRESQL_MIGRATION_ADMIN_PASSWORD" \
+    "$cmd" -h "$POSTGRESQL_MIGRATION_REMOTE_HOST" "$@"
+}
+
+# migration_progress_has STEP
+# ---------------------------
+# Succeed if the migration STEP was finished, according to the progress file.
+migration_progress_has ()
+{
+    grep -qxF -- "$1" "$migration_progress_file" 2>/dev/null
+}
+
+# migration_progress_add STEP
+# ---------------------------
+# Record the finished migration STEP in the progress file.
+migration_progress_add ()
+{
+    echo "$1" >> "$migration_progress_file"
+}
+
+# Succeed if a migration was started, but it didn't finish (e.g. the container
+# was killed in the middle of the migration).
+migration_incomplete ()
+{
+    test -f "$migration_progress_file" && ! migration_progress_has done
+}
+
 migrate_db ()
 {
     test "$postinitdb_actions" = ",migration" || return 0
 
+    local mode=${POSTGRESQL_MIGRATION_MODE:-dumpall}
+
+    # The progress file lives on the data volume, so the migration can continue
+    # where it was interrupted after the container is restarted.
+    if test -f "$migration_progress_file"; then
+        migration_progress_has done && return 0
+        if ! migration_progress_has "mode $mode"; then
+            echo >&2 "The interrupted migration was started with a different"
+            echo >&2 "\$POSTGRESQL_MIGRATION_MODE, it can not be resumed."
+            false
+        fi
+        echo "=> resuming the interrupted migration ..."
+        migration_resuming=:
+    else
+        echo "mode $mode" > "$migration_progress_file"
+        migration_resuming=false
+    fi
+
+    case $mode in
+      dumpall)
+        migrate_db_dumpall
+        ;;
+      parallel)
+        migrate_db_parallel
+        ;;
+      copy)
+        migrate_db_copy
+        ;;
+      *)
+        echo >&2 "Unsupported value: \$POSTGRESQL_MIGRATION_MODE=$POSTGRESQL_MIGRATION_MODE"
+        false
+        ;;
+    esac
+
+    migration_progress_add done
+}
+
+migrate_db_dumpall ()
+{
+    if $migration_resuming; then
+        echo >&2 "The migration in the 'dumpall' mode can not be resumed.  Remove"
+        echo >&2 "the content of the data volume to start the migration again, or"
+        echo >&2 "use the 'parallel' or 'copy' \$POSTGRESQL_MIGRATION_MODE."
+        false
+    fi
+
     set -o pipefail
     # Migration path.
     (
@@ -248,13 +1191,267 @@ migrate_db ()
         fi
         # initdb automatically creates 'postgres' role;  creating it again would
         # fail the whole migration so we drop it here
-        PGPASSWORD="$POSTGRESQL_MIGRATION_ADMIN_PASSWORD" \
-        pg_dumpall -h "$POSTGRESQL_MIGRATION_REMOTE_HOST" \
+        migration_remote pg_dumpall \
             | grep -v '^CREATE ROLE postgres;'
     ) | psql
     set +o pipefail
 }
 
+# Migrate roles and tablespaces only, databases are migrated separately.
+migrate_db_globals ()
+{
+    local dump_opts=()
+
+    migration_progress_has globals && return 0
+    echo "=> migrating global objects ..."
+
+    # No database was migrated yet, so the roles created by the interrupted
+    # migration don't own anything and can be dropped.
+    ! $migration_resuming || dump_opts+=( --clean --if-exists )
+
+    set -o pipefail
+    (
+        if [ ${POSTGRESQL_MIGRATION_IGNORE_ERRORS-no} = no ]; then
+            echo '\set ON_ERROR_STOP on'
+        fi
+        migration_remote pg_dumpall --globals-only "${dump_opts[@]}" \
+            | grep -v -e '^CREATE ROLE postgres;' -e '^DROP ROLE IF EXISTS postgres;'
+    ) | psql
+    set +o pipefail
+
+    migration_progress_add globals
+}
+
+# Print names of the remote databases that are going to be migrated (the same
+# set pg_dumpall would dump).
+migration_databases ()
+{
+    migration_remote psql -AtX -d postgres \
+        -c "SELECT datname FROM pg_database WHERE datallowconn AND datname <> 'template0' ORDER BY datname"
+}
+
+# local_database_exists DBNAME
+# ----------------------------
+local_database_exists ()
+{
+    test "$(psql -AtX -v dbname="$1" <<<"SELECT 1 FROM pg_database WHERE datname = :'dbname';")" = 1
+}
+
+# migration_restore_target DBNAME
+# -------------------------------
+# Set the $restore_target array to pg_restore options restoring DBNAME.  The
+# databases created by initdb ('postgres' and 'template1') are restored into
+# directly, all other databases are created by pg_restore.  Leftovers of an
+# interrupted migration of DBNAME are removed first.
+migration_restore_target ()
+{
+    local db=$1
+
+    if migration_progress_has "created $db"; then
+        psql -X -v ON_ERROR_STOP=1 -v dbname="$db" <<<'DROP DATABASE IF EXISTS :"dbname";'
+        restore_target=( --create --dbname=postgres )
+    elif local_database_exists "$db"; then
+        restore_target=( --dbname="$db" )
+        if migration_progress_has "started $db"; then
+            restore_target+=( --clean --if-exists )
+        else
+            migration_progress_add "started $db"
+        fi
+    else
+        migration_progress_add "created $db"
+        restore_target=( --create --dbname=postgres )
+    fi
+}
+
+# migration_restore_attributes DBNAME ARCHIVE
+# -------------------------------------------
+# pg_restore skips the database-level settings (ALTER DATABASE ... SET), grants
+# and comments unless it creates the database, so restore just those from the
+# ARCHIVE for the databases created by initdb, which are restored into.
+migration_restore_attributes ()
+{
+    local db=$1 archive=$2 list="$HOME/data/migration/attributes.list"
+    local exit_opts=()
+
+    test "${restore_target[0]}" != --create || return 0
+    if [ ${POSTGRESQL_MIGRATION_IGNORE_ERRORS-no} = no ]; then
+        exit_opts+=( --exit-on-error )
+    fi
+
+    pg_restore --list "$archive" \
+        | grep -E '^[0-9]+; [0-9]+ [0-9]+ (DATABASE PROPERTIES - |(ACL|COMMENT|SECURITY LABEL) - DATABASE )' \
+        > "$list" || :
+    if [ -s "$list" ]; then
+        # Without the DATABASE entry in the list, pg_restore neither creates
+        # nor connects to DBNAME, the statements name it explicitly.
+        pg_restore "${exit_opts[@]}" --create --use-list="$list" \
+            --dbname=postgres "$archive"
+    fi
+    rm -f "$list"
+}
+
+# Migrate every database separately with directory-format pg_dump and
+# pg_restore, both running $POSTGRESQL_MIGRATION_JOBS parallel jobs.  The
+# pg_restore loads all table data first and builds indexes and constraints
+# afterwards (again in parallel), so the migration time scales with the number
+# of CPUs.  The dump is temporarily stored on the data volume.  An interrupted
+# migration is resumed from the first database that was not fully migrated.
+migrate_db_parallel ()
+{
+    local jobs=${POSTGRESQL_MIGRATION_JOBS:-$(get_cpu_count)}
+    local dumpdir="$HOME/data/migration" db databases restore_target
+    local restore_opts=( --jobs="$jobs" )
+
+    if [ ${POSTGRESQL_MIGRATION_IGNORE_ERRORS-no} = no ]; then
+        restore_opts+=( --exit-on-error )
+    fi
+
+    migrate_db_globals
+
+    databases=$(migration_databases)
+    rm -rf "$dumpdir"
+    mkdir -p "$dumpdir"
+    while read -r db; do
+        test -n "$db" || continue
+        migration_progress_has "database $db" && continue
+        echo "=> migrating database '$db' using $jobs parallel jobs ..."
+        migration_remote pg_dump --format=directory --jobs="$jobs" \
+            --file="$dumpdir/dump" --dbname="$db"
+        migration_restore_target "$db"
+        pg_restore "${restore_opts[@]}" "${restore_target[@]}" "$dumpdir/dump"
+        migration_restore_attributes "$db" "$dumpdir/dump"
+        rm -rf "$dumpdir/dump"
+        migration_progress_add "database $db"
+    done <<<"$databases"
+    rm -rf "$dumpdir"
+}
+
+# migration_tables DBNAME
+# -----------------------
+# Print "TABLE SIZE" lines (TABLE is a quoted, schema-qualified name) for all
+# user tables of the remote database DBNAME, largest first.  Tables that belong
+# to extensions are skipped, those are re-created by CREATE EXTENSION.
+migration_tables ()
+{
+    migration_remote psql -AtX -F ' ' -d "$1" -c "
+      SELECT format('%I.%I', n.nspname, c.relname), pg_table_size(c.oid)
+        FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+       WHERE c.relkind = 'r'
+         AND n.nspname NOT IN ('pg_catalog', 'information_schema')
+         AND n.nspname NOT LIKE 'pg\_toast%'
+         AND n.nspname NOT LIKE 'pg\_temp%'
+         AND NOT EXISTS (SELECT 1 FROM pg_depend d
+                          WHERE d.classid = 'pg_class'::regclass
+                            AND d.objid = c.oid AND d.deptype = 'e')
+       ORDER BY 2 DESC"
+}
+
+# migration_copy_table DBNAME TABLE SIZE
+# --------------------------------------
+# Stream the data of TABLE from the remote database DBNAME into the local one
+# using binary COPY, and log the throughput.  The table is truncated in the
+# same transaction, so rows left by an interrupted migration are removed and
+# the new rows can be loaded already frozen.  Only TABLE itself is truncated,
+# its inheritance children are copied as tables of their own.
+migration_copy_table ()
+{
+    local db=$1 table=$2 size=$3 start elapsed result
+
+    start=$(date +%s%3N)
+    result=$(
+        set -o pipefail
+        migration_remote psql -X -d "$db" \
+            -c "COPY $table TO STDOUT (FORMAT binary)" </dev/null \
+        | psql -X -d "$db" --single-transaction -v ON_ERROR_STOP=1 \
+            -c "TRUNCATE ONLY $table" \
+            -c "COPY $table FROM STDIN (FORMAT binary, FREEZE)" \
+        | tail -n 1
+    ) || { echo >&2 "=> failed to copy $db: $table" ; return 1 ; }
+    elapsed=$(( $(date +%s%3N) - start ))
+    migration_progress_add "table $db $table"
+
+    echo "=> copied $db: $table, ${result#COPY } rows," \
+         "$(( size / 1048576 )) MB in $(( elapsed / 1000 )).$(( elapsed % 1000 / 100 )) s" \
+         "($(( size * 1000 / (elapsed + 1) / 1048576 )) MB/s)"
+}
+
+# migration_copy_tables DBNAME JOBS
+# ---------------------------------
+# Copy all the tables of DBNAME that were not copied yet, at most JOBS tables
+# at once.
+migration_copy_tables ()
+{
+    local db=$1 jobs=$2 tables line
+    local failed="$HOME/data/migration/failed"
+
+    tables=$(migration_tables "$db")
+    rm -f "$failed"
+    while read -r line; do
+        test -n "$line" || continue
+        migration_progress_has "table $db ${line% *}" && continue
+        while [ "$(jobs -pr | wc -l)" -ge "$jobs" ]; do
+            wait -n || :
+        done
+        { migration_copy_table "$db" "${line% *}" "${line##* }" || touch "$failed" ; } &
+    done <<<"$tables"
+    wait
+
+    if [ -e "$failed" ] && [ ${POSTGRESQL_MIGRATION_IGNORE_ERRORS-no} = no ]; then
+        echo >&2 "Failed to copy some tables of the '$db' database."
+        return 1
+    fi
+}
+
+# Migrate every database without any intermediate dump of the data: restore the
+# schema first, then stream the table data using binary COPY from the remote
+# server directly into the local one ($POSTGRESQL_MIGRATION_JOBS tables at
+# once), and finally build indexes and constraints.  This avoids both the SQL
+# text encoding/parsing and the temporary space for the dump.  An interrupted
+# migration is resumed from the tables that were not copied yet.
+migrate_db_copy ()
+{
+    local jobs=${POSTGRESQL_MIGRATION_JOBS:-$(get_cpu_count)}
+    local dumpdir="$HOME/data/migration" db databases restore_target
+    local restore_opts=() resume_opts
+
+    if [ ${POSTGRESQL_MIGRATION_IGNORE_ERRORS-no} = no ]; then
+        restore_opts+=( --exit-on-error )
+    fi
+
+    migrate_db_globals
+
+    databases=$(migration_databases)
+    rm -rf "$dumpdir"
+    mkdir -p "$dumpdir"
+    while read -r db; do
+        test -n "$db" || continue
+        migration_progress_has "database $db" && continue
+        echo "=> migrating database '$db' using $jobs parallel COPY streams ..."
+        # Everything but the table data, e.g. the schema, sequence values and
+        # large objects.  This is usually small.
+        migration_remote pg_dump --format=custom --exclude-table-data='*.*' \
+            --file="$dumpdir/schema" --dbname="$db"
+        if migration_progress_has "schema $db"; then
+            # The data and post-data sections might be partially restored.
+            resume_opts=( --clean --if-exists )
+        else
+            resume_opts=()
+            migration_restore_target "$db"
+            pg_restore "${restore_opts[@]}" --section=pre-data "${restore_target[@]}" "$dumpdir/schema"
+            migration_restore_attributes "$db" "$dumpdir/schema"
+            migration_progress_add "schema $db"
+        fi
+        migration_copy_tables "$db" "$jobs"
+        pg_restore "${restore_opts[@]}" "${resume_opts[@]}" --section=data \
+            --dbname="$db" "$dumpdir/schema"
+        pg_restore "${restore_opts[@]}" "${resume_opts[@]}" --section=post-data \
+            --jobs="$jobs" --dbname="$db" "$dumpdir/schema"
+        rm -f "$dumpdir/schema"
+        migration_progress_add "database $db"
+    done <<<"$databases"
+    rm -rf "$dumpdir"
+}
+
 function set_pgdata ()
 {
   export PGDATA=$HOME/data/userdata
@@ -285,6 +1482,115 @@ function wait_for_postgresql_master() {
 }
 
 
+# get_cluster_state [BINDIR]
+# --------------------------
+# Print the state of the $PGDATA cluster as recorded in its control file, e.g.
+# 'shut down' after a clean shutdown.  Use pg_controldata from BINDIR if set.
+get_cluster_state ()
+{
+  LC_ALL=C "${1:+$1/}pg_controldata" "$PGDATA" \
+    | sed -n 's/^Database cluster state: *//p'
+}
+
+# Print the control file field $1 of the $PGDATA cluster.
+get_local_control_field ()
+{
+  LC_ALL=C pg_controldata "$PGDATA" | sed -n "s/^$1: *//p"
+}
+
+# Print the position (in bytes) of the WAL location $1, e.g. '0/1A000028'.
+lsn_to_bytes ()
+{
+  echo $(( 0x${1%/*} * 0x100000000 + 0x${1#*/} ))
+}
+
+# wal_segment_to_bytes SEGMENT SEGMENT_SIZE
+# -----------------------------------------
+# Print the position (in bytes) of the start of the WAL segment file SEGMENT.
+wal_segment_to_bytes ()
+{
+  echo $(( 0x${1:8:8} * 0x100000000 + 0x${1:16:8} * $2 ))
+}
+
+# Print the WAL segment the startup process currently replays, taken from its
+# process title ('postgres: startup recovering SEGMENT').
+get_recovering_wal_segment ()
+{
+  local cmdline
+  for cmdline in /proc/[0-9]*/cmdline; do
+    tr '\0' ' ' < "$cmdline" 2>/dev/null
+    echo
+  done | sed -n 's/^postgres: .*startup recovering \([0-9A-F]\{24\}\).*/\1/p' | head -n 1
+}
+
+# Log the progress of the WAL replay every $POSTGRESQL_RECOVERY_PROGRESS_INTERVAL
+# seconds, until the server accepts connections.  The replay starts at the REDO
+# location of the last checkpoint and ends at the last segment in pg_wal.  Does
+# nothing if the cluster was shut down cleanly.  The reporter runs in
+# background, and may become a child process of the postmaster, so it must
+# always exit with zero (see run_post_start_job).
+start_recovery_progress_reporter ()
+{
+  test "$POSTGRESQL_RECOVERY_PROGRESS_INTERVAL" -gt 0 || return 0
+  case $(get_cluster_state) in
+    "shut down"|"shut down in recovery") return 0 ;;
+  esac
+
+  (
+    set +e
+    local segment_size redo begin_pos end_segment end_pos segment pos
+    segment_size=$(get_local_control_field "Bytes per WAL segment")
+    redo=$(get_local_control_field "Latest checkpoint's REDO location")
+    end_segment=$(ls "$PGDATA/pg_wal" | grep -E '^[0-9A-F]{24}$' | tail -n 1)
+    test -n "$segment_size" && test -n "$redo" && test -n "$end_segment" || exit 0
+    begin_pos=$(lsn_to_bytes "$redo")
+    end_pos=$(( $(wal_segment_to_bytes "$end_segment" "$segment_size") + segment_size ))
+    echo "=> Recovering the WAL from $redo to the end of segment $end_segment," \
+         "$(( (end_pos - begin_pos) / 1048576 )) MB"
+    while sleep "$POSTGRESQL_RECOVERY_PROGRESS_INTERVAL"; do
+      pg_isready -q && break
+      segment=$(get_recovering_wal_segment)
+      test -n "$segment" || continue
+      pos=$(wal_segment_to_bytes "$segment" "$segment_size")
+      test "$pos" -gt "$begin_pos" || pos=$begin_pos
+      echo "=> Recovery in progress: replaying segment $segment," \
+           "$(( (pos - begin_pos) * 100 / (end_pos - begin_pos) ))% done," \
+           "$(( (end_pos - pos) / 1048576 )) MB left"
+    done
+    exit 0
+  ) </dev/null &
+}
+
+# disable_unknown_settings PGENGINE
+# ---------------------------------
+# Comment out the settings of the generated configuration that the server in
+# the PGENGINE directory does not know (e.g. maintenance_io_concurrency for
+# PostgreSQL 12), which would be fatal for the old server started during the
+# upgrade.  The extension settings (with a dot) are accepted by any server.
+# The enable_unknown_settings function puts them back.
+disable_unknown_settings ()
+{
+  local known config
+  known=$("$1"/postgres --describe-config) || return 1
+  config=$(awk -F '\t' '
+      NR == FNR { known[tolower($1)]; next }
+      match($0, /^[A-Za-z_][A-Za-z0-9_]*[ \t]*=/) {
+        name = tolower($0)
+        sub(/[ \t]*=.*/, "", name)
+        if (!(name in known) && name !~ /^include(_if_exists|_dir)?$/) {
+          print "#unknown-setting# " $0
+          next
+        }
+      }
+      { print }' <(printf '%s\n' "$known") "$POSTGRESQL_CONFIG_FILE") || return 1
+  printf '%s\n' "$config" > "$POSTGRESQL_CONFIG_FILE"
+}
+
+enable_unknown_settings ()
+{
+  sed -i -e 's/^#unknown-setting# //' "$POSTGRESQL_CONFIG_FILE"
+}
+
 run_pgupgrade ()
 (
   # Remove .pid file if the file persists after ugly shut down
@@ -293,6 +1599,7 @@ run_pgupgrade ()
   fi
 
   optimized=false
+  transfer_opts=()
   old_raw_version=${POSTGRESQL_PREV_VERSION//\./}
   new_raw_version=${POSTGRESQL_VERSION//\./}
 
@@ -320,20 +1627,46 @@ run_pgupgrade ()
     hardlink)
       optimized=:
       ;;
+    clone)
+      # Reflinks are nearly as fast as hard links, but the old data directory
+      # stays intact.  Only some filesystems (e.g. XFS or btrfs) support them.
+      if cp --reflink=always "$PGDATA/PG_VERSION" "$HOME/data/.reflink-test" 2>/dev/null; then
+        transfer_opts+=(--clone)
+      else
+        info_msg "File cloning is not supported on the data volume, falling back to copy."
+      fi
+      rm -f "$HOME/data/.reflink-test"
+      ;;
+    copy-file-range)
+      if test "$new_raw_version" -lt 17; then
+        echo >&2 "\$POSTGRESQL_UPGRADE=copy-file-range requires PostgreSQL 17 or newer"
+        false
+      fi
+      transfer_opts+=(--copy-file-range)
+      ;;
     *)
       echo >&2 "Unsupported value: \$POSTGRESQL_UPGRADE=$POSTGRESQL_UPGRADE"
       false
       ;;
   esac
 
-  # boot up data directory with old postgres once again to make sure
-  # it was shut down properly, otherwise the upgrade process fails
-  info_msg "Starting old postgresql once again for a clean shutdown..."
-  "${old_pgengine}/pg_ctl" start -w --timeout 86400 -o "-h 127.0.0.1''"
-  info_msg "Waiting for postgresql to be ready for shutdown again..."
-  "${old_pgengine}/pg_isready" -h 127.0.0.1
-  info_msg "Shutting down old postgresql cleanly..."
-  "${old_pgengine}/pg_ctl" stop
+  # The configuration is generated for the new server.
+  disable_unknown_settings "$old_pgengine"
+
+  # pg_upgrade fails unless the old cluster was shut down properly;  if it was
+  # not, boot up the data directory with old postgres once again (the crash
+  # recovery happens) and shut it down cleanly.
+  cluster_state=$(get_cluster_state "$old_pgengine")
+  if test "$cluster_state" = "shut down"; then
+    info_msg "Old postgresql was shut down cleanly, skipping the start/stop cycle."
+  else
+    info_msg "Old postgresql cluster state is '$cluster_state', starting it once again for a clean shutdown..."
+    "${old_pgengine}/pg_ctl" start -w --timeout 86400 -o "-h 127.0.0.1''"
+    info_msg "Waiting for postgresql to be ready for shutdown again..."
+    "${old_pgengine}/pg_isready" -h 127.0.0.1
+    info_msg "Shutting down old postgresql cleanly..."
+    "${old_pgengine}/pg_ctl" stop
+  fi
 
   # Ensure $PGDATA_new doesn't exist yet, so we can immediately remove it if
   # there's some problem.
@@ -357,6 +1690,10 @@ run_pgupgrade ()
 
   # Dangerous --link option, we loose $DATADIR if something goes wrong.
   ! $optimized || upgrade_cmd+=(--link)
+  upgrade_cmd+=("${transfer_opts[@]}")
+
+  # Process the databases and tablespaces in parallel.
+  upgrade_cmd+=("--jobs=$(get_cpu_count)")
 
   # User-specififed options for pg_upgrade.
   eval "upgrade_cmd+=(${POSTGRESQL_UPGRADE_PGUPGRADE_OPTIONS-})"
@@ -380,8 +1717,9 @@ run_pgupgrade ()
   rm -rf "$PGDATA"
   mv "$PGDATA_new" "$PGDATA"
 
-  # Get back the option we changed above
+  # Get back the options we changed above
   sed -i -e 's/#data_sync_retry/data_sync_retry/' "${POSTGRESQL_CONFIG_FILE}"
+  enable_unknown_settings
 
   info_msg "Upgrade DONE."
 )
@@ -454,6 +1792,581 @@ try_pgupgrade ()
   fi
 
   run_pgupgrade
+  pg_upgraded=:
+}
+
+# write_startup_timings [READY_MS]
+# --------------------------------
+# Write the startup timings measured so far to $startup_timings_file, for the
+# probes and the sidecar containers, together with the phase in progress.
+# READY_MS is the time the final server started to accept connections, if it
+# does already.
+write_startup_timings ()
+{
+  local ready_ms=${1:-} phase sep= tmp=$startup_timings_file.tmp
+  {
+    printf '{\n  "begin_ms": %s,\n' "$startup_begin_ms"
+    if test -n "$ready_ms"; then
+      printf '  "ready": true,\n  "total_ms": %s,\n' "$((ready_ms - startup_begin_ms))"
+    else
+      printf '  "ready": false,\n  "total_ms": null,\n'
+    fi
+    if test -n "$startup_current_phase"; then
+      printf '  "current_phase": "%s",\n' "$startup_current_phase"
+    else
+      printf '  "current_phase": null,\n'
+    fi
+    printf '  "phases": ['
+    for phase in "${startup_phases[@]}"; do
+      set -- $phase
+      printf '%s\n    {"name": "%s", "start_ms": %s, "duration_ms": %s}' \
+          "$sep" "$1" "$(($2 - startup_begin_ms))" "$(($3 - $2))"
+      sep=,
+    done
+    printf '\n  ]\n}\n'
+  } > "$tmp" && mv -f "$tmp" "$startup_timings_file"
+}
+
+# startup_phase NAME COMMAND [ARG ...]
+# ------------------------------------
+# Run COMMAND in the current shell, log how long it took and record it in
+# $startup_timings_file.  A failing COMMAND terminates the script (errexit) as
+# if it was run directly; only in a condition, its exit status is returned.
+startup_phase ()
+{
+  local phase_name=$1 phase_begin_ms phase_end_ms phase_status
+  shift
+  phase_begin_ms=$(date +%s%3N)
+  startup_current_phase=$phase_name
+  write_startup_timings
+  "$@"
+  phase_status=$?
+  phase_end_ms=$(date +%s%3N)
+  echo "=> Startup phase $phase_name took $((phase_end_ms - phase_begin_ms)) ms"
+  startup_current_phase=
+  startup_phases+=( "$phase_name $phase_begin_ms $phase_end_ms" )
+  write_startup_timings
+  return $phase_status
+}
+
+# Record the 'server_start' phase, from now (just before the 'exec postgres')
+# until the final server accepts connections.  The readiness is polled once a
+# second, see run_post_start_job.
+record_server_start ()
+{
+  startup_current_phase=server_start
+  write_startup_timings
+  run_post_start_job "recording the startup timings" \
+      record_server_ready "$(date +%s%3N)"
+}
+
+record_server_ready ()
+{
+  local begin_ms=$1 end_ms
+  end_ms=$(date +%s%3N)
+  startup_current_phase=
+  startup_phases+=( "server_start $begin_ms $end_ms" )
+  write_startup_timings "$end_ms"
+  echo "=> The server accepts connections $((end_ms - startup_begin_ms)) ms after the container start"
+}
+
+# run_post_start_job DESCRIPTION COMMAND [ARG ...]
+# ------------------------------------------------
+# Run COMMAND in background, once the final server (the 'exec postgres' which
+# replaces this shell) accepts connections.  The job becomes a child process of
+# the postmaster, which handles a non-zero exit status of an unknown child as
+# a backend crash -- so the job must always exit with zero.
+run_post_start_job ()
+{
+  local description=$1 server_pid=$$
+  shift
+  (
+    set +e
+    until test "$(head -n 1 "$PGDATA/postmaster.pid" 2>/dev/null)" = "$server_pid" \
+          && pg_isready -q; do
+      sleep 1
+    done
+    echo "=> $description ..."
+    # The jobs run while the standbys connect, or when there are none yet, so
+    # their commits must not wait for the synchronous ones.
+    export PGOPTIONS="${PGOPTIONS:-} -c synchronous_commit=local"
+    # In a subshell of its own, as the command may enable errexit.
+    if ( "$@" ); then
+      echo "=> $description finished"
+    else
+      echo >&2 "=> $description failed"
+    fi
+    exit 0
+  ) </dev/null &
+}
+
+# Run the actions that need a running server on every container start: the
+# extensions, the privileges for the replicas and the start hooks.  All the
+# setup statements (those queued by create_users, too) run in a single psql
+# session once the hooks are processed.  The user-supplied hooks may expect
+# the users and the database to exist, so the statements queued so far run
+# before them in that case.
+run_start_actions ()
+{
+  grant_rewind_privileges
+  create_extensions
+  if test -n "$(get_matched_files '*.sh' "${APP_DATA}/src/postgresql-start")"; then
+    run_setup_sql
+  fi
+  process_extending_files \
+      "${APP_DATA}/src/postgresql-start" \
+      "${CONTAINER_SCRIPTS_PATH}/start"
+  run_setup_sql
+  (umask 077; passwords_checksum > "$passwords_checksum_file")
+}
+
+# Print a checksum of the variables the start/set_passwords.sh hook of the
+# image applies.
+passwords_checksum ()
+{
+  local var
+  for var in postinitdb_actions POSTGRESQL_USER POSTGRESQL_PASSWORD \
+             POSTGRESQL_MASTER_USER POSTGRESQL_MASTER_PASSWORD \
+             POSTGRESQL_ADMIN_PASSWORD; do
+    printf '%s%s=%s\0' "$var" "${!var+ (set)}" "${!var-}"
+  done | sha256sum | cut -d ' ' -f 1
+}
+
+# Succeed if there is any action for run_start_actions.  The image itself
+# provides a start hook setting the passwords, which has nothing to do when the
+# passwords did not change since the last start (unless a user hook of the same
+# name replaces it).
+have_start_actions ()
+{
+  local hooks
+  test -v POSTGRESQL_EXTENSIONS && return 0
+  test "${ENABLE_REPLICATION}" = true && test -v POSTGRESQL_MASTER_USER && return 0
+  hooks=$(get_matched_files '*.sh' "${APP_DATA}/src/postgresql-start" \
+                                   "${CONTAINER_SCRIPTS_PATH}/start" | sort -u)
+  if test "$hooks" = set_passwords.sh \
+      && test ! -f "${APP_DATA}/src/postgresql-start/set_passwords.sh" \
+      && test "$(cat "$passwords_checksum_file" 2>/dev/null)" = "$(passwords_checksum)"; then
+    return 1
+  fi
+  test -n "$hooks"
+}
+
+# Succeed if an existing data directory can be started without the temporary
+# server, because nothing has to run before the server accepts connections
+# (or POSTGRESQL_DEFER_START_HOOKS=true allows to run the start actions after
+# that).  This saves a server start and a shutdown checkpoint.
+can_skip_temporary_server ()
+{
+  if $pg_upgraded && test "${POSTGRESQL_UPGRADE_ANALYZE:-no}" = foreground; then
+    return 1
+  fi
+  test "${POSTGRESQL_DEFER_START_HOOKS:-false}" = true && return 0
+  ! have_start_actions
+}
+
+# The pg_upgrade doesn't transfer the planner statistics, so rebuild them once
+# the data directory was upgraded.  Depending on $POSTGRESQL_UPGRADE_ANALYZE,
+# the statistics are built before the server starts to accept connections, or
+# in background after the server started.
+analyze_upgraded_cluster ()
+{
+  $pg_upgraded || return 0
+
+  local analyze_cmd=( vacuumdb --all --analyze-in-stages --jobs="$(get_cpu_count)" )
+
+  case ${POSTGRESQL_UPGRADE_ANALYZE:-no} in
+    no)
+      ;;
+    foreground)
+      echo "=> rebuilding planner statistics after upgrade ..."
+      "${analyze_cmd[@]}"
+      ;;
+    background)
+      run_post_start_job "rebuilding planner statistics after upgrade" "${analyze_cmd[@]}"
+      ;;
+    *)
+      echo >&2 "Unsupported value: \$POSTGRESQL_UPGRADE_ANALYZE=$POSTGRESQL_UPGRADE_ANALYZE"
+      false
+      ;;
+  esac
+}
+
+# Print the names of the base backups in the WAL archive, oldest first.  Only
+# the complete backups have the backup_info file.
+list_base_backups ()
+{
+  local name
+  for name in $(wal_archive_list basebackups); do
+    if wal_archive_exists "basebackups/$name/backup_info"; then
+      echo "$name"
+    fi
+  done
+}
+
+# get_base_backup_info NAME FIELD
+# -------------------------------
+# Print the FIELD of the backup_info file of the base backup NAME.
+get_base_backup_info ()
+{
+  wal_archive_get "basebackups/$1/backup_info" | sed -n "s/^$2=//p"
+}
+
+# Take a base backup of the running server to the WAL archive.  The backup
+# does not include the WAL, the server waits until the WAL needed to restore
+# it is archived.  The backup_info file records the first WAL segment the
+# backup needs, and when it finished (the backup is consistent from then on).
+take_base_backup ()
+(
+  set -o pipefail
+  local name log start_lsn timeline segment_size start_segment
+  name=$(date -u +%Y%m%dT%H%M%SZ)
+  log=$(mktemp) || return 1
+
+  echo "=> Taking the base backup $name to $wal_archive_url ..."
+  if ! pg_basebackup --pgdata=- --format=tar --wal-method=none \
+          --checkpoint=fast --label="$name" --verbose 2>"$log" \
+        | wal_compress 0 \
+        | wal_archive_put "basebackups/$name/base.tar$(wal_archive_suffix)"; then
+    cat "$log" >&2
+    rm -f "$log"
+    wal_archive_remove "basebackups/$name"
+    return 1
+  fi
+
+  start_lsn=$(sed -n 's/.*write-ahead log start point: \([0-9A-F]*\/[0-9A-F]*\) on timeline.*/\1/p' "$log")
+  timeline=$(sed -n 's/.*write-ahead log start point: .* on timeline \([0-9]*\).*/\1/p' "$log")
+  rm -f "$log"
+  segment_size=$(get_local_control_field "Bytes per WAL segment")
+  start_segment=$(printf '%08X%08X%08X' "$timeline" "$((0x${start_lsn%/*}))" \
+                      "$((0x${start_lsn#*/} / segment_size))")
+
+  printf '%s\n' \
+      "start_lsn=$start_lsn" \
+      "timeline=$timeline" \
+      "start_wal_segment=$start_segment" \
+      "stop_epoch=$(date +%s)" \
+    | wal_archive_put "basebackups/$name/backup_info"
+)
+
+# Remove the base backups but the last $POSTGRESQL_BASE_BACKUP_RETENTION ones,
+# and the archived WAL segments older than the oldest backup kept.  The
+# timeline history files are always kept.
+prune_base_backups ()
+{
+  local backups kept name start file segment
+  backups=$(list_base_backups)
+  test -n "$backups" || return 0
+  kept=$(tail -n "$POSTGRESQL_BASE_BACKUP_RETENTION" <<<"$backups")
+
+  for name in $(wal_archive_list basebackups); do
+    # The backups removed by the retention, and the failed ones.
+    if ! grep -qxF "$name" <<<"$kept"; then
+      echo "=> Removing the base backup $name"
+      wal_archive_remove "basebackups/$name"
+    fi
+  done
+
+  start=$(get_base_backup_info "$(head -n 1 <<<"$kept")" start_wal_segment)
+  test -n "$start" || return 0
+  for file in $(wal_archive_list wal); do
+    segment=${file%%.*}
+    [[ $segment =~ ^[0-9A-F]{24}$ ]] || continue
+    if [[ ${segment:8} < ${start:8} ]]; then
+      wal_archive_remove "wal/$file" >/dev/null
+    fi
+  done
+}
+
+# Take a base backup to the WAL archive every $POSTGRESQL_BASE_BACKUP_INTERVAL
+# hours (right away if the last one is older), and prune the old ones.  This
+# runs as a post-start job for the life of the server, see start_base_backups.
+run_base_backups ()
+{
+  local interval=$((POSTGRESQL_BASE_BACKUP_INTERVAL * 3600)) latest age
+  while :; do
+    age=$interval
+    latest=$(list_base_backups | tail -n 1)
+    if test -n "$latest"; then
+      age=$(( $(date +%s) - $(get_base_backup_info "$latest" stop_epoch) ))
+    fi
+    if [ "$age" -lt "$interval" ]; then
+      sleep $((interval - age))
+    elif take_base_backup; then
+      prune_base_backups
+    else
+      echo >&2 "=> Taking the base backup failed, retrying in 10 minutes"
+      sleep 600
+    fi
+  done
+}
+
+start_base_backups ()
+{
+  if [ -n "$wal_archive_url" ] && [ "$POSTGRESQL_BASE_BACKUP_INTERVAL" -gt 0 ]; then
+    run_post_start_job "taking the periodic base backups" run_base_backups
+  fi
+}
+
+# Prepare a new data directory in a staging directory next to $PGDATA, which
+# the caller fills in and commit_staged_data_directory renames to $PGDATA.  So
+# a failure never leaves a partial data directory in $PGDATA, which the next
+# start would take for an initialized one.  $PGDATA points to the staging
+# directory meanwhile, so this is meant for the subshell of the caller.
+stage_data_directory ()
+{
+  staged_pgdata=$PGDATA
+  PGDATA=$staged_pgdata.new
+  rm -rf "$PGDATA"
+  mkdir -p "$PGDATA"
+  chmod 0700 "$PGDATA"
+  trap 'rm -rf "$staged_pgdata.new"' EXIT
+}
+
+# Replace the (empty) $PGDATA with the staging directory prepared by
+# stage_data_directory, once it is filled in completely.
+commit_staged_data_directory ()
+{
+  rmdir "$staged_pgdata" || return 1
+  mv "$PGDATA" "$staged_pgdata" || return 1
+  trap - EXIT
+  PGDATA=$staged_pgdata
+}
+
+# extract_tarball NAME DIR
+# ------------------------
+# Extract the tarball read from the standard input to DIR, decompressing it as
+# the suffix of NAME says.
+extract_tarball ()
+{
+  wal_decompress "$1" | tar -xf - -C "$2"
+}
+
+# find_tarball DIR NAME
+# ---------------------
+# Print the path of the (possibly compressed) NAME.tar file in DIR, as written
+# by 'pg_basebackup --format=tar'.  Fails if there is none.
+find_tarball ()
+{
+  local file
+  for file in "$1/$2.tar" "$1/$2.tar".{zst,lz4,gz}; do
+    if test -f "$file"; then
+      echo "$file"
+      return 0
+    fi
+  done
+  return 1
+}
+
+# copy_data_directory SRC DEST
+# ----------------------------
+# Copy the data directory SRC to DEST.  The directories of the databases in
+# base/, which usually hold most of the data, are copied in parallel.
+copy_data_directory ()
+{
+  local src=$1 dest=$2
+  find "$src" -mindepth 1 -maxdepth 1 ! -name base -print0 \
+    | xargs -0 -r cp -R --preserve=mode,timestamps -t "$dest"
+  mkdir -p "$dest/base"
+  find "$src/base" -mindepth 1 -maxdepth 1 -print0 \
+    | xargs -0 -r -n 1 -P "$(get_cpu_count)" cp -R --preserve=mode,timestamps -t "$dest/base"
+}
+
+# Verify the seeded data directory against the manifest of the backup, if
+# it has one.  The WAL is only checked if the backup includes it.
+verify_seeded_backup ()
+{
+  local opts=()
+  if [ "${POSTGRESQL_SEED_VERIFY:-true}" != true ]; then
+    return 0
+  fi
+  if [ ! -f "$PGDATA/backup_manifest" ]; then
+    echo "=> The backup has no manifest, it can not be verified"
+    return 0
+  fi
+  if [ -z "$(ls "$PGDATA/pg_wal" | grep -E '^[0-9A-F]{24}$')" ]; then
+    opts+=( --no-parse-wal )
+  fi
+  echo "=> Verifying the backup ..."
+  pg_verifybackup --quiet "${opts[@]}" "$PGDATA"
+}
+
+# Seed the empty data directory from the physical base backup in
+# $POSTGRESQL_SEED_FROM instead of running initdb: a directory written by
+# pg_basebackup (in the plain format, or in the tar format with the tarballs
+# compressed with zstd, lz4 or gzip), or a tarball of a data directory.  In the
+# tar format, the data and the WAL are extracted in parallel.
+seed_data_directory ()
+(
+  set -o pipefail
+  local seed=$POSTGRESQL_SEED_FROM base wal pids=() pid
+
+  echo "=> Seeding the data directory from $seed ..."
+  stage_data_directory
+  if [ -f "$seed" ]; then
+    extract_tarball "$seed" "$PGDATA" < "$seed"
+  elif [ -f "$seed/PG_VERSION" ]; then
+    copy_data_directory "$seed" "$PGDATA"
+  elif base=$(find_tarball "$seed" base); then
+    extract_tarball "$base" "$PGDATA" < "$base" &
+    pids+=( $! )
+    if wal=$(find_tarball "$seed" pg_wal); then
+      mkdir -p "$PGDATA/pg_wal"
+      extract_tarball "$wal" "$PGDATA/pg_wal" < "$wal" &
+      pids+=( $! )
+    fi
+    for pid in "${pids[@]}"; do
+      wait "$pid" || return 1
+    done
+    if [ -f "$seed/backup_manifest" ]; then
+      cp "$seed/backup_manifest" "$PGDATA"
+    fi
+  else
+    echo >&2 "=> There is no base backup in $seed"
+    return 1
+  fi
+  mkdir -p "$PGDATA/pg_wal"
+  chmod 0700 "$PGDATA"
+
+  verify_seeded_backup
+  rm -f "$PGDATA/backup_manifest" "$migration_progress_file"
+  configure_data_directory
+  commit_staged_data_directory
+)
+
+# Restore the empty data directory from the last base backup in the WAL
+# archive finished before $POSTGRESQL_RESTORE_TARGET_TIME ('latest' for the
+# last one).  The server then replays the archived WAL up to that time, and
+# gets promoted, see generate_postgresql_archive_config.
+restore_from_archive ()
+(
+  set -o pipefail
+  local target=$POSTGRESQL_RESTORE_TARGET_TIME target_epoch= backup= name file
+
+  if [ "$target" != latest ] && ! target_epoch=$(date -d "$target" +%s); then
+    echo >&2 "Unsupported value: \$POSTGRESQL_RESTORE_TARGET_TIME=$target"
+    return 1
+  fi
+  for name in $(list_base_backups); do
+    if [ -n "$target_epoch" ] \
+        && [ "$(get_base_backup_info "$name" stop_epoch)" -gt "$target_epoch" ]; then
+      break
+    fi
+    backup=$name
+  done
+  if [ -z "$backup" ]; then
+    echo >&2 "=> There is no base backup to restore $target from in $wal_archive_url"
+    return 1
+  fi
+
+  file=$(wal_archive_list "basebackups/$backup" | grep '^base\.tar' | head -n 1)
+  echo "=> Restoring the base backup $backup from $wal_archive_url ..."
+  stage_data_directory
+  wal_archive_get "basebackups/$backup/$file" | extract_tarball "$file" "$PGDATA"
+  rm -rf "$HOME/wal-restore-spool"
+  touch "$PGDATA/recovery.signal"
+  commit_staged_data_directory
+)
+
+# Wait until the server restored by restore_from_archive reaches the recovery
+# target and gets promoted.
+wait_for_recovery_end ()
+{
+  echo "=> Waiting for the recovery to reach ${POSTGRESQL_RESTORE_TARGET_TIME} ..."
+  until test "$(psql -X -At -c 'SELECT pg_is_in_recovery();' 2>/dev/null)" = f; do
+    pg_ctl status >/dev/null || return 1
+    sleep 1
+  done
+}
+
+# The built-in connection pooler, see start_pooler.
+pooler_dir=$HOME/pgbouncer
+
+generate_pooler_config ()
+{
+    local cpus pool_size server_conns
+
+    # Leave some connections for superusers, replication and the clients that
+    # connect directly to the server.
+    server_conns=$(( POSTGRESQL_MAX_CONNECTIONS - 10 ))
+    test "$server_conns" -ge 1 || server_conns=1
+
+    # A few busy server connections per core are enough to saturate the CPUs,
+    # more only add contention.
+    cpus=$(get_cpu_count)
+    pool_size=${POSTGRESQL_POOLER_POOL_SIZE:-$(( cpus * 2 + 1 ))}
+    test "$pool_size" -le "$server_conns" || pool_size=$server_conns
+
+    mkdir -p "$pooler_dir"
+
+    # There are no passwords stored here, PgBouncer looks them up in the server
+    # using the auth_query (over the local socket, which is trusted).
+    : > "$pooler_dir/userlist.txt"
+
+    cat > "$pooler_dir/pgbouncer.ini" <<EOF
+;
+; PgBouncer configuration generated by run-postgresql.
+;
+; NOTE: This file is rewritten every time the container is started!
+;
+
+[databases]
+* = host=/var/run/postgresql port=5432
+
+[pgbouncer]
+listen_addr = *
+listen_port = ${POSTGRESQL_POOLER_PORT}
+unix_socket_dir =
+pidfile = ${pooler_dir}/pgbouncer.pid
+logfile =
+
+auth_type = md5
+auth_file = ${pooler_dir}/userlist.txt
+auth_user = postgres
+auth_query = SELECT usename, passwd FROM pg_catalog.pg_shadow WHERE usename = \$1
+admin_users = postgres
+
+pool_mode = ${POSTGRESQL_POOLER_MODE}
+max_client_conn = ${POSTGRESQL_POOLER_MAX_CLIENT_CONN:-1000}
+default_pool_size = ${pool_size}
+max_db_connections = ${server_conns}
+ignore_startup_parameters = extra_float_digits,search_path
+EOF
+}
+
+# Start PgBouncer next to the server if POSTGRESQL_POOLER=pgbouncer.  This
+# must be called right before 'exec postgres', as the pooler is then a child
+# process of the postmaster.  The subshell restarts the pooler if it dies and
+# never exits (a non-zero exit status would be considered a backend crash).
+start_pooler ()
+{
+    case ${POSTGRESQL_POOLER:-} in
+        "") return 0 ;;
+        pgbouncer) ;;
+        *)
+            echo >&2 "Unsupported value: \$POSTGRESQL_POOLER=$POSTGRESQL_POOLER"
+            return 1
+            ;;
+    esac
+
+    case $POSTGRESQL_POOLER_MODE in
+        session|transaction) ;;
+        *)
+            echo >&2 "Unsupported value: \$POSTGRESQL_POOLER_MODE=$POSTGRESQL_POOLER_MODE"
+            return 1
+            ;;
+    esac
+
+    generate_pooler_config
+
+    echo "Starting PgBouncer on port $POSTGRESQL_POOLER_PORT ($POSTGRESQL_POOLER_MODE pooling) ..."
+    (
+        set +e
+        while :; do
+            pgbouncer "$pooler_dir/pgbouncer.ini"
+            echo >&2 "PgBouncer exited with status $?, restarting"
+            sleep 1
+        done
+    ) </dev/null &
 }
 
 # get_matched_files PATTERN DIR [DIR ...]
@@ -493,7 +2406,7 @@ create_extensions()
 {
   if [ -v POSTGRESQL_EXTENSIONS ]; then
     for EXT in $POSTGRESQL_EXTENSIONS; do
-      psql -c "CREATE EXTENSION IF NOT EXISTS ${EXT};"
+      queue_setup_sql "CREATE EXTENSION IF NOT EXISTS ${EXT};"
     done
   fi
 }
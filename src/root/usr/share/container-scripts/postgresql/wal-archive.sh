@@ -0,0 +1,192 @@
+# Access to the WAL archive set by $POSTGRESQL_WAL_ARCHIVE, shared by
+# common.sh and the archive_command/restore_command helpers in /usr/libexec.
+#
+# The archive is either a local directory (e.g. a mounted volume), or an
+# s3://BUCKET/PREFIX URL of an S3-compatible object store.  The object store is
+# accessed using the 'aws' command line client, which is not part of the image;
+# it takes the credentials from the AWS_* variables, and the endpoint of
+# non-AWS stores from $POSTGRESQL_WAL_ARCHIVE_S3_ENDPOINT.
+#
+# The layout of the archive:
+#   wal/FILE[.zst|.gz]                       the WAL segments and history files
+#   basebackups/NAME/base.tar[.zst|.gz]      the base backups
+#   basebackups/NAME/backup_info             see take_base_backup
+
+wal_archive_url=${POSTGRESQL_WAL_ARCHIVE:-}
+wal_archive_url=${wal_archive_url%/}
+
+# The number of the WAL files pushed or fetched in parallel.
+wal_archive_jobs=${POSTGRESQL_WAL_ARCHIVE_JOBS:-4}
+
+wal_archive_compression=${POSTGRESQL_WAL_ARCHIVE_COMPRESSION:-zstd}
+
+wal_archive_is_s3 ()
+{
+  [[ $wal_archive_url == s3://* ]]
+}
+
+wal_archive_aws ()
+{
+  aws ${POSTGRESQL_WAL_ARCHIVE_S3_ENDPOINT:+--endpoint-url "$POSTGRESQL_WAL_ARCHIVE_S3_ENDPOINT"} \
+      --only-show-errors s3 "$@"
+}
+
+# wal_archive_put NAME
+# --------------------
+# Store the standard input as NAME in the archive.  The file appears in the
+# archive only once it is complete.
+wal_archive_put ()
+{
+  if wal_archive_is_s3; then
+    wal_archive_aws cp - "$wal_archive_url/$1"
+    return
+  fi
+
+  local file=$wal_archive_url/$1
+  local tmp=${file%/*}/.${file##*/}.$$
+  mkdir -p "${file%/*}" \
+    && cat > "$tmp" \
+    && sync "$tmp" \
+    && mv -f "$tmp" "$file" \
+    || { rm -f "$tmp"; return 1; }
+}
+
+# wal_archive_get NAME
+# --------------------
+# Print the archived file NAME to the standard output.
+wal_archive_get ()
+{
+  if wal_archive_is_s3; then
+    wal_archive_aws cp "$wal_archive_url/$1" - 2>/dev/null
+  else
+    cat "$wal_archive_url/$1" 2>/dev/null
+  fi
+}
+
+# Succeed if NAME is archived.
+wal_archive_exists ()
+{
+  if wal_archive_is_s3; then
+    wal_archive_aws ls "$wal_archive_url/$1" 2>/dev/null \
+      | awk -v name="${1##*/}" '$NF == name { found = 1 } END { exit !found }'
+  else
+    test -f "$wal_archive_url/$1"
+  fi
+}
+
+# Print the names of the files and directories in the archive directory DIR,
+# sorted.
+wal_archive_list ()
+{
+  if wal_archive_is_s3; then
+    wal_archive_aws ls "$wal_archive_url/$1/" 2>/dev/null | awk '{ sub("/$", "", $NF); print $NF }'
+  else
+    ls -1 "$wal_archive_url/$1" 2>/dev/null
+  fi | LC_ALL=C sort
+}
+
+# Remove the archived file or directory NAME.
+wal_archive_remove ()
+{
+  if wal_archive_is_s3; then
+    wal_archive_aws rm --recursive "$wal_archive_url/$1"
+  else
+    rm -rf "${wal_archive_url:?}/$1"
+  fi
+}
+
+# Print the file name suffix of the configured compression.
+wal_archive_suffix ()
+{
+  case $wal_archive_compression in
+    zstd) echo .zst ;;
+    gzip) echo .gz ;;
+  esac
+}
+
+# wal_compress [THREADS]
+# ----------------------
+# Compress the standard input with the configured compression.  Only zstd
+# compresses with more than one thread.
+wal_compress ()
+{
+  case $wal_archive_compression in
+    zstd) zstd -q -c -T"${1:-1}" ;;
+    gzip) gzip -c ;;
+    *)    cat ;;
+  esac
+}
+
+# Decompress the standard input, compressed as the suffix of NAME says.  The
+# lz4 and xz suffixes are used by the seed backups, see seed_data_directory.
+wal_decompress ()
+{
+  case $1 in
+    *.zst)      zstd -q -d -c ;;
+    *.gz|*.tgz) gzip -d -c ;;
+    *.lz4)      lz4 -q -d -c ;;
+    *.xz)       xz -d -c -T0 ;;
+    *)          cat ;;
+  esac
+}
+
+# wal_archive_fetch FILE DEST
+# ---------------------------
+# Fetch the archived WAL file FILE to DEST, whatever compression it was
+# archived with.  The DEST appears only once it is complete.  Returns 1 if FILE
+# is not archived, and 2 if it can not be fetched.
+wal_archive_fetch ()
+{
+  local file=$1 dest=$2 suffixes suffix name
+  suffixes=( "$(wal_archive_suffix)" )
+  for suffix in .zst .gz ""; do
+    test "$suffix" = "${suffixes[0]}" || suffixes+=( "$suffix" )
+  done
+
+  for suffix in "${suffixes[@]}"; do
+    name=wal/$file$suffix
+    wal_archive_exists "$name" || continue
+    if wal_archive_get "$name" | wal_decompress "$name" > "$dest.tmp"; then
+      mv -f "$dest.tmp" "$dest"
+      return 0
+    fi
+    rm -f "$dest.tmp"
+    echo >&2 "=> Failed to fetch $name from $wal_archive_url"
+    return 2
+  done
+  return 1
+}
+
+# wal_archive_push FILE PATH
+# --------------------------
+# Archive the WAL file FILE, read from PATH.  It is compressed to a temporary
+# file first, so that a failed compression never leaves a truncated file in
+# the archive.
+wal_archive_push ()
+{
+  local file=$1 path=$2 name tmp status=0
+  name=wal/$file$(wal_archive_suffix)
+  if wal_archive_exists "$name"; then
+    # Pushed before, e.g. by a container which stopped before the server
+    # recorded that.  Never overwrite it, just check it is the same file.
+    wal_archive_get "$name" | wal_decompress "$name" | cmp -s - "$path"
+    return
+  fi
+  tmp=$(mktemp "${TMPDIR:-/tmp}/wal-archive.XXXXXX") || return 1
+  wal_compress < "$path" > "$tmp" && wal_archive_put "$name" < "$tmp" || status=$?
+  rm -f "$tmp"
+  return "$status"
+}
+
+# wal_next_segment SEGMENT SEGMENT_SIZE
+# -------------------------------------
+# Print the name of the WAL segment following SEGMENT on the same timeline.
+wal_next_segment ()
+{
+  local log=$((0x${1:8:8})) seg=$((0x${1:16:8} + 1))
+  if [ "$seg" -ge $((0x100000000 / $2)) ]; then
+    log=$((log + 1))
+    seg=0
+  fi
+  printf '%s%08X%08X\n' "${1:0:8}" "$log" "$seg"
+}
@@ -0,0 +1,145 @@
+import shutil
+import tempfile
+from time import sleep
+
+import pytest
+
+from container_ci_suite.container_lib import ContainerTestLib
+from container_ci_suite.engines.podman_wrapper import PodmanCLIWrapper
+from container_ci_suite.utils import ContainerTestLibUtils
+
+from conftest import VARS, create_and_wait_for_container
+
+
+class TestPostgreSQLArchiveContainer:
+    """
+    Test PostgreSQL container WAL archiving, point-in-time recovery and seeding
+    from a base backup.
+    """
+
+    def setup_method(self):
+        """
+        Setup the test environment.
+        """
+        self.db = ContainerTestLib(image_name=VARS.IMAGE_NAME, db_type=VARS.DB_TYPE)
+        self.archive_dir = tempfile.mkdtemp(prefix="/tmp/psql-archive-dir")
+        ContainerTestLibUtils.commands_to_run(
+            commands_to_run=[
+                f"setfacl -m u:26:rwx {self.archive_dir}",
+                f"setfacl -d -m u:26:rwx {self.archive_dir}",
+            ]
+        )
+
+    def teardown_method(self):
+        """
+        Teardown the test environment.
+        """
+        self.db.cleanup()
+        shutil.rmtree(self.archive_dir, ignore_errors=True)
+
+    def test_archive_and_restore(self):
+        """
+        Test the data can be restored from the WAL archive.
+        Steps:
+        1. Create a container archiving to a volume and wait for the base backup.
+        2. Insert data and archive the current WAL segment.
+        3. Restore a new container from the archive and check the data.
+        """
+        container_args = [
+            "-e POSTGRESQL_ADMIN_PASSWORD=password",
+            "-e POSTGRESQL_WAL_ARCHIVE=/archive",
+            f"-v {self.archive_dir}:/archive:Z",
+        ]
+        cid, _ = create_and_wait_for_container(
+            db=self.db,
+            cid_file_name="archive_primary",
+            container_args=container_args,
+            command="",
+        )
+        for _ in range(30):
+            output = PodmanCLIWrapper.podman_exec_shell_command(
+                cid_file_name=cid,
+                cmd="ls /archive/basebackups/*/backup_info || true",
+            )
+            if "backup_info" in output:
+                break
+            sleep(2)
+        assert "backup_info" in output, f"No base backup in the archive: {output}"
+        segment = PodmanCLIWrapper.podman_exec_shell_command(
+            cid_file_name=cid,
+            cmd='psql -tA -c "CREATE TABLE t1 (a integer); INSERT INTO t1 VALUES (24);"'
+            ' -c "SELECT pg_walfile_name(pg_switch_wal());"',
+        ).strip().splitlines()[-1]
+        for _ in range(30):
+            archived = PodmanCLIWrapper.podman_exec_shell_command(
+                cid_file_name=cid,
+                cmd='psql -tA -c "SELECT last_archived_wal FROM pg_stat_archiver;"',
+            ).strip()
+            if archived >= segment:
+                break
+            sleep(1)
+        assert archived >= segment, (
+            f"The WAL segment {segment} was not archived, the last one is {archived}"
+        )
+        cid, _ = create_and_wait_for_container(
+            db=self.db,
+            cid_file_name="archive_restored",
+            container_args=container_args
+            + [
+                "-e POSTGRESQL_RESTORE_TARGET_TIME=latest",
+                "-e POSTGRESQL_BASE_BACKUP_INTERVAL=0",
+            ],
+            command="",
+        )
+        output = PodmanCLIWrapper.podman_exec_shell_command(
+            cid_file_name=cid,
+            cmd='psql -tA -c "SELECT a FROM t1;"',
+        )
+        assert output.strip() == "24", f"Restored table t1 should contain 24: {output}"
+
+    @pytest.mark.parametrize(
+        "compression",
+        [
+            "--gzip",
+            "--compress=server-zstd",
+            "--compress=client-lz4",
+        ],
+    )
+    def test_seed_from_base_backup(self, compression):
+        """
+        Test a new container can be seeded from a base backup.
+        Steps:
+        1. Create a container, insert data and take a compressed base backup.
+        2. Seed a new container from the backup and check the data.
+        """
+        if VARS.VERSION in ["12", "13", "14"] and compression != "--gzip":
+            pytest.skip(f"{compression} is not supported by {VARS.VERSION}")
+        container_args = [
+            "-e POSTGRESQL_ADMIN_PASSWORD=password",
+            f"-v {self.archive_dir}:/seed:Z",
+        ]
+        cid, _ = create_and_wait_for_container(
+            db=self.db,
+            cid_file_name="seed_source",
+            container_args=container_args,
+            command="",
+        )
+        PodmanCLIWrapper.podman_exec_shell_command(
+            cid_file_name=cid,
+            cmd='psql -c "CREATE TABLE t1 (a integer); INSERT INTO t1 VALUES (24);"',
+        )
+        PodmanCLIWrapper.podman_exec_shell_command(
+            cid_file_name=cid,
+            cmd=f"pg_basebackup --pgdata=/seed/backup --format=tar {compression}",
+        )
+        cid, _ = create_and_wait_for_container(
+            db=self.db,
+            cid_file_name="seed_target",
+            container_args=container_args + ["-e POSTGRESQL_SEED_FROM=/seed/backup"],
+            command="",
+        )
+        output = PodmanCLIWrapper.podman_exec_shell_command(
+            cid_file_name=cid,
+            cmd='psql -tA -c "SELECT a FROM t1;"',
+        )
+        assert output.strip() == "24", f"Seeded table t1 should contain 24: {output}"
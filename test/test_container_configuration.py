@@ -1,5 +1,9 @@
+import json
 import shutil
 import tempfile
+from pathlib import Path
+from time import sleep
+
 import pytest
 
 from container_ci_suite.engines.podman_wrapper import PodmanCLIWrapper
@@ -79,6 +83,62 @@ class TestPostgreSQLInvalidConfigurations:
             command="",
         )
 
+    def test_invalid_tuning_profile(self):
+        """
+        Test container creation fails with an unknown tuning profile.
+        """
+        assert self.db.assert_container_creation_fails(
+            cid_file_name="invalid_tuning_profile",
+            container_args=[
+                "-e POSTGRESQL_ADMIN_PASSWORD=password",
+                "-e POSTGRESQL_TUNING_PROFILE=unknown",
+            ],
+            command="",
+        )
+
+    def test_invalid_setting(self):
+        """
+        Test container creation fails with an invalid setting value, which is
+        reported by the configuration check before the data directory is
+        initialized.
+        """
+        volume_dir = tempfile.mkdtemp(prefix="/tmp/psql-volume-dir")
+        try:
+            ContainerTestLibUtils.commands_to_run(
+                commands_to_run=[
+                    f"setfacl -m u:26:-wx {volume_dir}",
+                ]
+            )
+            output = PodmanCLIWrapper.call_podman_command(
+                cmd=f"run --rm -e POSTGRESQL_ADMIN_PASSWORD=password "
+                f"-e POSTGRESQL_WORK_MEM=lots "
+                f"-v {volume_dir}:/var/lib/pgsql/data:Z {VARS.IMAGE_NAME}",
+                ignore_error=True,
+            )
+            assert "Invalid configuration" in output, (
+                f"The configuration check should fail, but the output is {output}"
+            )
+            assert "work_mem" in output
+            assert not Path(volume_dir, "userdata", "PG_VERSION").exists(), (
+                "initdb should not run with an invalid configuration"
+            )
+        finally:
+            shutil.rmtree(volume_dir, ignore_errors=True)
+
+    def test_invalid_conf_variable(self):
+        """
+        Test container creation fails with a POSTGRESQL_CONF_<name> value of
+        the wrong type.
+        """
+        assert self.db.assert_container_creation_fails(
+            cid_file_name="invalid_conf_variable",
+            container_args=[
+                "-e POSTGRESQL_ADMIN_PASSWORD=password",
+                "-e POSTGRESQL_CONF_jit=maybe",
+            ],
+            command="",
+        )
+
 
 class TestPostgreSQLValidConfigurations:
     """
@@ -161,6 +221,254 @@ class TestPostgreSQLValidConfigurations:
                 database=psql_database,
             )
 
+    @pytest.mark.parametrize(
+        "profile, maintenance_work_mem, max_wal_size",
+        [
+            ("oltp", "32MB", "8GB"),
+            ("olap", "64MB", "16GB"),
+            ("web", "32MB", "4GB"),
+        ],
+    )
+    def test_tuning_profile(self, profile, maintenance_work_mem, max_wal_size):
+        """
+        Test the settings computed by the tuning profile for a 512MB container.
+        """
+        cid_file_name = f"tuning_profile_{profile}"
+        cid, _ = create_and_wait_for_container(
+            db=self.db,
+            cid_file_name=cid_file_name,
+            container_args=[
+                "--memory=512m",
+                "-e POSTGRESQL_ADMIN_PASSWORD=password",
+                f"-e POSTGRESQL_TUNING_PROFILE={profile}",
+                "-e POSTGRESQL_WORK_MEM=8MB",
+            ],
+            command="",
+        )
+        expected = {
+            "maintenance_work_mem": maintenance_work_mem,
+            "max_wal_size": max_wal_size,
+            "checkpoint_completion_target": "0.9",
+            "work_mem": "8MB",
+        }
+        for setting, value in expected.items():
+            output = PodmanCLIWrapper.podman_exec_shell_command(
+                cid_file_name=cid,
+                cmd=f'psql -tA -c "SHOW {setting};"',
+            )
+            assert value in output, f"{setting} should be {value}, but is {output}"
+
+    def test_conf_variables(self):
+        """
+        Test the settings passed by the POSTGRESQL_CONF_<name> variables, which
+        override the tuning profile and the other variables.
+        """
+        cid, _ = create_and_wait_for_container(
+            db=self.db,
+            cid_file_name="conf_variables",
+            container_args=[
+                "-e POSTGRESQL_ADMIN_PASSWORD=password",
+                "-e POSTGRESQL_TUNING_PROFILE=web",
+                "-e POSTGRESQL_WORK_MEM=8MB",
+                "-e POSTGRESQL_CONF_work_mem=12MB",
+                "-e POSTGRESQL_CONF_CHECKPOINT_TIMEOUT=15min",
+                "-e POSTGRESQL_CONF_JIT=off",
+            ],
+            command="",
+        )
+        expected = {
+            "work_mem": "12MB",
+            "checkpoint_timeout": "15min",
+            "jit": "off",
+        }
+        for setting, value in expected.items():
+            output = PodmanCLIWrapper.podman_exec_shell_command(
+                cid_file_name=cid,
+                cmd=f'psql -tA -c "SHOW {setting};"',
+            )
+            assert value in output, f"{setting} should be {value}, but is {output}"
+
+    def test_light_probe(self):
+        """
+        Test the light readiness probe reuses the result of the last full check
+        until every --connect-every probe, with a state per set of options.
+        """
+        cid, _ = create_and_wait_for_container(
+            db=self.db,
+            cid_file_name="light_probe",
+            container_args=[
+                "-e POSTGRESQL_ADMIN_PASSWORD=password",
+            ],
+            command="",
+        )
+        probe = "/usr/libexec/check-container --light --connect-every=3"
+        counts = []
+        for _ in range(4):
+            PodmanCLIWrapper.call_podman_command(cmd=f"exec {cid} {probe}")
+            output = PodmanCLIWrapper.podman_exec_shell_command(
+                cid_file_name=cid,
+                cmd="cat /tmp/check-container-*.state",
+            )
+            # "<postmaster state> <probes since the full check> <result>"
+            counts.append(output.split()[-2])
+        # The full check (and its query) runs on the first and fourth probes.
+        assert counts == ["1", "2", "3", "1"], f"Unexpected probe counts {counts}"
+
+        PodmanCLIWrapper.call_podman_command(
+            cmd=f"exec {cid} {probe} --replica-lag-max=10",
+        )
+        output = PodmanCLIWrapper.podman_exec_shell_command(
+            cid_file_name=cid,
+            cmd="ls /tmp/check-container-*.state",
+        )
+        assert len(output.split()) == 2, (
+            f"The probes with other options should keep their own state: {output}"
+        )
+
+    def test_cpu_parallelism(self):
+        """
+        Test the parallelism settings computed for a container limited to 2 CPUs.
+        """
+        cid, _ = create_and_wait_for_container(
+            db=self.db,
+            cid_file_name="cpu_parallelism",
+            container_args=[
+                "--cpus=2",
+                "-e POSTGRESQL_ADMIN_PASSWORD=password",
+                "-e POSTGRESQL_MAX_PARALLEL_MAINTENANCE_WORKERS=2",
+            ],
+            command="",
+        )
+        expected = {
+            "max_worker_processes": "8",
+            "max_parallel_workers": "2",
+            "max_parallel_workers_per_gather": "1",
+            "max_parallel_maintenance_workers": "2",
+        }
+        for setting, value in expected.items():
+            output = PodmanCLIWrapper.podman_exec_shell_command(
+                cid_file_name=cid,
+                cmd=f'psql -tA -c "SHOW {setting};"',
+            )
+            assert output.strip() == value, (
+                f"{setting} should be {value}, but is {output}"
+            )
+
+    def test_startup_timings(self):
+        """
+        Test the startup timings are recorded once the server is ready.
+        """
+        cid, _ = create_and_wait_for_container(
+            db=self.db,
+            cid_file_name="startup_timings",
+            container_args=["-e POSTGRESQL_ADMIN_PASSWORD=password"],
+            command="",
+        )
+        for _ in range(10):
+            output = PodmanCLIWrapper.podman_exec_shell_command(
+                cid_file_name=cid,
+                cmd="cat /var/lib/pgsql/startup-timings.json",
+            )
+            timings = json.loads(output)
+            if timings["ready"]:
+                break
+            sleep(1)
+        assert timings["ready"], f"Server not ready in {output}"
+        phases = [phase["name"] for phase in timings["phases"]]
+        for phase in ["initdb", "temporary_server_start", "server_start"]:
+            assert phase in phases, f"Phase {phase} not found in {output}"
+
+    def test_storage_type(self):
+        """
+        Test the planner and I/O settings for the nvme storage type.
+        """
+        cid, _ = create_and_wait_for_container(
+            db=self.db,
+            cid_file_name="storage_type_nvme",
+            container_args=[
+                "-e POSTGRESQL_ADMIN_PASSWORD=password",
+                "-e POSTGRESQL_STORAGE_TYPE=nvme",
+            ],
+            command="",
+        )
+        expected = {
+            "random_page_cost": "1.1",
+            "effective_io_concurrency": "500",
+        }
+        for setting, value in expected.items():
+            output = PodmanCLIWrapper.podman_exec_shell_command(
+                cid_file_name=cid,
+                cmd=f'psql -tA -c "SHOW {setting};"',
+            )
+            assert output.strip() == value, (
+                f"{setting} should be {value}, but is {output}"
+            )
+
+    def test_wal_replay_settings(self):
+        """
+        Test the WAL replay settings on PostgreSQL 15 and newer.
+        """
+        if VARS.VERSION in ["12", "13"]:
+            pytest.skip(f"WAL prefetching is not supported by {VARS.VERSION}")
+        cid, _ = create_and_wait_for_container(
+            db=self.db,
+            cid_file_name="wal_replay_settings",
+            container_args=[
+                "-e POSTGRESQL_ADMIN_PASSWORD=password",
+                "-e POSTGRESQL_RECOVERY_PROGRESS_INTERVAL=5",
+                "-e POSTGRESQL_WAL_DECODE_BUFFER_SIZE=8MB",
+            ],
+            command="",
+        )
+        expected = {
+            "log_startup_progress_interval": "5s",
+            "recovery_prefetch": "try",
+            "wal_decode_buffer_size": "8MB",
+            "maintenance_io_concurrency": "200",
+        }
+        for setting, value in expected.items():
+            output = PodmanCLIWrapper.podman_exec_shell_command(
+                cid_file_name=cid,
+                cmd=f'psql -tA -c "SHOW {setting};"',
+            )
+            assert output.strip() == value, (
+                f"{setting} should be {value}, but is {output}"
+            )
+
+    @pytest.mark.parametrize(
+        "dsm_setting, dsm_type",
+        [
+            ("", "posix"),
+            ("mmap", "mmap"),
+        ],
+    )
+    def test_dynamic_shared_memory(self, dsm_setting, dsm_type):
+        """
+        Test the dynamic shared memory stays in a small /dev/shm, unless files
+        are asked for.
+        """
+        container_args = [
+            "--shm-size=64m",
+            "-e POSTGRESQL_ADMIN_PASSWORD=password",
+        ]
+        if dsm_setting:
+            container_args.append(
+                f"-e POSTGRESQL_DYNAMIC_SHARED_MEMORY_TYPE={dsm_setting}"
+            )
+        cid, _ = create_and_wait_for_container(
+            db=self.db,
+            cid_file_name=f"dynamic_shared_memory_{dsm_type}",
+            container_args=container_args,
+            command="",
+        )
+        output = PodmanCLIWrapper.podman_exec_shell_command(
+            cid_file_name=cid,
+            cmd='psql -tA -c "SHOW dynamic_shared_memory_type;"',
+        )
+        assert output.strip() == dsm_type, (
+            f"dynamic_shared_memory_type should be {dsm_type}, but is {output}"
+        )
+
 
 class TestPostgreSQLBufferHooks:
     """
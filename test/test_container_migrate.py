@@ -38,11 +38,12 @@ class TestPostgreSQLMigration:
         self.db.cleanup()
         shutil.rmtree(self.migrate_volume_dir, ignore_errors=True)
 
+    @pytest.mark.parametrize("migration_mode", ["dumpall", "parallel", "copy"])
     @pytest.mark.parametrize(
         "version_to_migrate",
         VARS.MIGRATION_PATHS,
     )
-    def test_migration_functionality(self, version_to_migrate):
+    def test_migration_functionality(self, version_to_migrate, migration_mode):
         """
         Test migration functionality of the PostgreSQL container.
         Steps are:
@@ -65,7 +66,7 @@ class TestPostgreSQLMigration:
                 f"{self.registry_image} image not found in registry so skipping migration test.."
             )
         cip = self.start_database(version=version_to_migrate)
-        self.migrate_image(cip=cip)
+        self.migrate_image(cip=cip, migration_mode=migration_mode)
 
     def start_database(self, version) -> str:
         """
@@ -90,18 +91,29 @@ class TestPostgreSQLMigration:
         PodmanCLIWrapper.call_podman_command(
             cmd=f"run --rm -i {VARS.IMAGE_NAME} bash -c '{psql_cmd}' < {file_path}",
         )
+        for sql in [
+            "ALTER DATABASE postgres SET work_mem TO 7777",
+            "CREATE TABLE parent_table (id int)",
+            "CREATE TABLE child_table () INHERITS (parent_table)",
+            "INSERT INTO parent_table SELECT generate_series(1, 10)",
+            "INSERT INTO child_table SELECT generate_series(1, 10000)",
+        ]:
+            PodmanCLIWrapper.call_podman_command(
+                cmd=f"run --rm {VARS.IMAGE_NAME} bash -c '{psql_cmd} -c \"{sql}\"'",
+            )
         check_pagila_db(cid=cid_create)
         return cip_create
 
-    def migrate_image(self, cip: str):
+    def migrate_image(self, cip: str, migration_mode: str):
         """
         Migrate the image.
         """
         self.db.image_name = VARS.IMAGE_NAME
-        cid_file_name = "migrate-test"
+        cid_file_name = f"migrate-test-{migration_mode}"
         container_args = [
             f"-e POSTGRESQL_MIGRATION_REMOTE_HOST={cip}",
             f"-e POSTGRESQL_MIGRATION_ADMIN_PASSWORD={self.admin_password}",
+            f"-e POSTGRESQL_MIGRATION_MODE={migration_mode}",
         ]
         cid_migrate, _ = create_and_wait_for_container(
             db=self.db,
@@ -110,3 +122,19 @@ class TestPostgreSQLMigration:
             command="",
         )
         check_pagila_db(cid=cid_migrate)
+        # The copy of a parent table (the smaller one, so copied after the
+        # child) must not truncate its children.
+        for table, rows in [("ONLY parent_table", "10"), ("child_table", "10000")]:
+            output = PodmanCLIWrapper.podman_exec_shell_command(
+                cid_file_name=cid_migrate,
+                cmd=f'psql -tA -c "SELECT count(*) FROM {table};"',
+            )
+            assert output.strip() == rows, f"{table} should have {rows} rows, but has {output}"
+        if migration_mode != "dumpall":
+            # The settings of the databases created by initdb are restored
+            # separately from their content.
+            output = PodmanCLIWrapper.podman_exec_shell_command(
+                cid_file_name=cid_migrate,
+                cmd='psql -tA -c "SHOW work_mem;"',
+            )
+            assert "7777kB" in output, f"work_mem should be 7777kB, but is {output}"
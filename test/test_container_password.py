@@ -1,5 +1,7 @@
 import tempfile
 
+import pytest
+
 from container_ci_suite.container_lib import ContainerTestLib
 from container_ci_suite.container_lib import ContainerTestLibUtils
 from container_ci_suite.engines.podman_wrapper import PodmanCLIWrapper
@@ -32,9 +34,11 @@ class TestPostgreSQLPasswordChangeContainer:
         self.db.cleanup()
         shutil.rmtree(self.pwd_dir, ignore_errors=True)
 
-    def test_password_change(self):
+    @pytest.mark.parametrize("defer_start_hooks", [False, True])
+    def test_password_change(self, defer_start_hooks):
         """
-        Test password change.
+        Test password change, optionally with the start hooks run after the
+        server starts (without the temporary server).
         """
 
         pwd_file_name = "test_password_change"
@@ -93,7 +97,7 @@ class TestPostgreSQLPasswordChangeContainer:
         pwd_file_name_new = "test_password_change_new_password"
         new_password = f"NEW_{password}"
         new_admin_password = f"NEW_{admin_password}"
-        _, cip_new = create_and_wait_for_container(
+        cid_new, cip_new = create_and_wait_for_container(
             db=self.db,
             cid_file_name=pwd_file_name_new,
             container_args=[
@@ -101,6 +105,7 @@ class TestPostgreSQLPasswordChangeContainer:
                 f"-e POSTGRESQL_PASSWORD={new_password}",
                 f"-e POSTGRESQL_DATABASE={database}",
                 f"-e POSTGRESQL_ADMIN_PASSWORD={new_admin_password}",
+                f"-e POSTGRESQL_DEFER_START_HOOKS={str(defer_start_hooks).lower()}",
                 volume_options,
             ],
             command="",
@@ -133,6 +138,8 @@ class TestPostgreSQLPasswordChangeContainer:
                 )
                 login_access = False
         assert login_access
+        logs = PodmanCLIWrapper.podman_logs(container_id=cid_new)
+        assert defer_start_hooks == ("Skipping the temporary server start" in logs)
         check_db_output(
             dw_api=self.db.db_lib,
             cip=cip_new,
@@ -140,3 +147,40 @@ class TestPostgreSQLPasswordChangeContainer:
             password=new_password,
             database=database,
         )
+
+    def test_restart_same_passwords(self):
+        """
+        Test a restart with unchanged passwords skips the temporary server,
+        as the password hook has nothing to do, and a restart with a changed
+        password does not.
+        """
+        volume_options = f"-v {self.pwd_dir}:/var/lib/pgsql/data:Z"
+        container_args = [
+            "-e POSTGRESQL_USER=user",
+            "-e POSTGRESQL_DATABASE=db",
+            "-e POSTGRESQL_ADMIN_PASSWORD=adminPassword",
+            volume_options,
+        ]
+        for cid_file_name, password, skipped in [
+            ("test_same_passwords_init", "password", False),
+            ("test_same_passwords_restart", "password", True),
+            ("test_same_passwords_change", "new_password", False),
+        ]:
+            cid, cip = create_and_wait_for_container(
+                db=self.db,
+                cid_file_name=cid_file_name,
+                container_args=container_args + [f"-e POSTGRESQL_PASSWORD={password}"],
+                command="",
+            )
+            assert self.db.test_db_connection(
+                container_ip=cip,
+                username="user",
+                password=password,
+                max_attempts=10,
+            )
+            logs = PodmanCLIWrapper.podman_logs(container_id=cid)
+            assert skipped == ("Skipping the temporary server start" in logs), (
+                f"The temporary server should {'' if skipped else 'not '}be skipped"
+            )
+            PodmanCLIWrapper.call_podman_command(cmd=f"stop {cid}")
+            PodmanCLIWrapper.call_podman_command(cmd=f"rm {cid}")
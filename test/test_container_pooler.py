@@ -0,0 +1,58 @@
+import pytest
+
+from container_ci_suite.container_lib import ContainerTestLib
+from container_ci_suite.engines.podman_wrapper import PodmanCLIWrapper
+
+from conftest import VARS, create_and_wait_for_container
+
+
+class TestPostgreSQLPoolerContainer:
+    """
+    Test PostgreSQL container with the built-in PgBouncer connection pooler.
+    """
+
+    def setup_method(self):
+        """
+        Setup the test environment.
+        """
+        self.db = ContainerTestLib(image_name=VARS.IMAGE_NAME, db_type=VARS.DB_TYPE)
+
+    def teardown_method(self):
+        """
+        Teardown the test environment.
+        """
+        self.db.cleanup()
+
+    @pytest.mark.parametrize("pool_mode", ["transaction", "session"])
+    def test_pooler_connection(self, pool_mode):
+        """
+        Test that the clients can connect through PgBouncer with their password.
+        Steps:
+        1. Create a container with the pooler enabled in the given pool mode.
+        2. Connect through the pooler port with the correct password.
+        3. Check that a wrong password is rejected by the pooler.
+        """
+        cid_file_name = f"test_pooler_{pool_mode}"
+        cid, _ = create_and_wait_for_container(
+            db=self.db,
+            cid_file_name=cid_file_name,
+            container_args=[
+                "-e POSTGRESQL_USER=user",
+                "-e POSTGRESQL_PASSWORD=pass",
+                "-e POSTGRESQL_DATABASE=db",
+                "-e POSTGRESQL_POOLER=pgbouncer",
+                f"-e POSTGRESQL_POOLER_MODE={pool_mode}",
+            ],
+            command="",
+        )
+        output = PodmanCLIWrapper.call_podman_command(
+            cmd=f"exec {cid} bash -c \"PGPASSWORD=pass psql -h 127.0.0.1 -p 6432 "
+            f"-U user -d db -tA -c 'SELECT 42;'\"",
+        )
+        assert "42" in output, f"Query through the pooler failed: {output}"
+        output = PodmanCLIWrapper.call_podman_command(
+            cmd=f"exec {cid} bash -c \"PGPASSWORD=wrong psql -h 127.0.0.1 -p 6432 "
+            f"-U user -d db -tA -c 'SELECT 42;'\"",
+            ignore_error=True,
+        )
+        assert "42" not in output, "The pooler accepted a wrong password"
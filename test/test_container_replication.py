@@ -1,7 +1,14 @@
+import json
 import re
+import shutil
+import tempfile
 from time import sleep
 
+import pytest
+
 from container_ci_suite.container_lib import ContainerTestLib
+from container_ci_suite.container_lib import ContainerTestLibUtils
+from container_ci_suite.engines.podman_wrapper import PodmanCLIWrapper
 
 from conftest import VARS, create_and_wait_for_container
 
@@ -23,9 +30,18 @@ class TestPostgreSQLReplicationContainer:
         """
         self.db.cleanup()
 
-    def test_replication(self):
+    @pytest.mark.parametrize(
+        "slot_name, sync_replicas",
+        [
+            ("", ""),
+            ("Replica-1", ""),
+            ("", "ANY 1"),
+        ],
+    )
+    def test_replication(self, slot_name, sync_replicas):
         """
-        Test replication.
+        Test replication, optionally using a replication slot or synchronous
+        replication.
         """
         database = "postgres"
         master_user = "master"
@@ -39,6 +55,8 @@ class TestPostgreSQLReplicationContainer:
             f"-e POSTGRESQL_MASTER_USER={master_user}",
             f"-e POSTGRESQL_MASTER_PASSWORD={master_password}",
         ]
+        if sync_replicas:
+            container_args.append(f'-e POSTGRESQL_SYNC_REPLICAS="{sync_replicas}"')
         # Run the PostgreSQL master
         _, master_cip = create_and_wait_for_container(
             db=self.db,
@@ -49,8 +67,11 @@ class TestPostgreSQLReplicationContainer:
         container_args += [
             f"--add-host {master_hostname}:{master_cip}",
             f"-e POSTGRESQL_MASTER_IP={master_hostname}",
+            "-e POSTGRESQL_BASEBACKUP_MAX_RATE=100M",
         ]
-        _, slave_cip = create_and_wait_for_container(
+        if slot_name:
+            container_args.append(f"-e POSTGRESQL_REPLICATION_SLOT_NAME={slot_name}")
+        slave_cid, slave_cip = create_and_wait_for_container(
             db=self.db,
             cid_file_name=slave_cid_name,
             container_args=container_args,
@@ -67,6 +88,30 @@ class TestPostgreSQLReplicationContainer:
         assert slave_cip in output, (
             f"Replica {slave_cip} not found in MASTER {master_cip}"
         )
+        if slot_name:
+            output = self.db.db_lib.run_sql_command(
+                container_ip=master_cip,
+                username=master_user,
+                password=master_password,
+                database=database,
+                sql_cmd="-At -c 'select slot_name from pg_replication_slots where active;'",
+                expected_output="replica_1",
+            )
+            assert "replica_1" in output, (
+                f"Active replication slot replica_1 not found in MASTER {master_cip}"
+            )
+        if sync_replicas:
+            output = self.db.db_lib.run_sql_command(
+                container_ip=master_cip,
+                username=master_user,
+                password=master_password,
+                database=database,
+                sql_cmd="-At -c 'select sync_state from pg_stat_replication;'",
+                expected_output="quorum",
+            )
+            assert "quorum" in output, (
+                f"Replica {slave_cip} is not a synchronous standby of MASTER {master_cip}"
+            )
         # Test the replication
         output = self.db.db_lib.run_sql_command(
             container_ip=master_cip,
@@ -87,3 +132,205 @@ class TestPostgreSQLReplicationContainer:
         assert re.search(r"^24", output), (
             f"Value 24 not found in REPLICA {slave_cip} for table t1"
         )
+        # The replica is up to date, check-container fails otherwise
+        PodmanCLIWrapper.call_podman_command(
+            cmd=f"exec {slave_cid} /usr/libexec/check-container --replica-lag-max=16MB",
+        )
+        for _ in range(3):
+            PodmanCLIWrapper.call_podman_command(
+                cmd=f"exec {slave_cid} /usr/libexec/check-container --light "
+                "--connect-every=2 --replica-lag-max=16MB",
+            )
+        output = PodmanCLIWrapper.call_podman_command(
+            cmd=f"exec {slave_cid} /usr/libexec/check-container --status",
+        )
+        status = json.loads(output)
+        assert status["in_recovery"], f"REPLICA {slave_cip} is not in recovery: {output}"
+
+
+class TestPostgreSQLSyncReplicationRestart:
+    """
+    Test the restart of a primary configured for synchronous replication.
+    """
+
+    def setup_method(self):
+        """
+        Setup the test environment.
+        """
+        self.db = ContainerTestLib(image_name=VARS.IMAGE_NAME, db_type=VARS.DB_TYPE)
+        self.data_dir = tempfile.mkdtemp(prefix="/tmp/psql-sync-restart")
+        ContainerTestLibUtils.commands_to_run(
+            commands_to_run=[
+                f"setfacl -m u:26:-wx {self.data_dir}",
+            ]
+        )
+
+    def teardown_method(self):
+        """
+        Teardown the test environment.
+        """
+        self.db.cleanup()
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+    @pytest.mark.parametrize("defer_start_hooks", [False, True])
+    def test_sync_master_restart(self, defer_start_hooks):
+        """
+        Test a primary waiting for a synchronous standby which is not there
+        still initializes and restarts: the setup statements (e.g. the
+        password changes) must not wait for the standby.
+        """
+        username = "user"
+        database = "db"
+        container_args = [
+            f"-e POSTGRESQL_USER={username}",
+            f"-e POSTGRESQL_DATABASE={database}",
+            "-e POSTGRESQL_MASTER_USER=master",
+            "-e POSTGRESQL_MASTER_PASSWORD=master",
+            '-e POSTGRESQL_SYNC_REPLICAS="ANY 1"',
+            f"-e POSTGRESQL_DEFER_START_HOOKS={str(defer_start_hooks).lower()}",
+            f"-v {self.data_dir}:/var/lib/pgsql/data:Z",
+        ]
+        cid1, _ = create_and_wait_for_container(
+            db=self.db,
+            cid_file_name="sync_master",
+            container_args=container_args + ["-e POSTGRESQL_PASSWORD=password"],
+            command="run-postgresql-master",
+        )
+        PodmanCLIWrapper.call_podman_command(cmd=f"kill {cid1}")
+        PodmanCLIWrapper.call_podman_command(cmd=f"rm {cid1}")
+        _, cip = create_and_wait_for_container(
+            db=self.db,
+            cid_file_name="sync_master_restarted",
+            container_args=container_args + ["-e POSTGRESQL_PASSWORD=new_password"],
+            command="run-postgresql-master",
+        )
+        assert self.db.test_db_connection(
+            container_ip=cip,
+            username=username,
+            password="new_password",
+            max_attempts=10,
+        )
+
+
+class TestPostgreSQLReplicaRestart:
+    """
+    Test the reuse of the data directory of a restarted replica.
+    """
+
+    def setup_method(self):
+        """
+        Setup the test environment.
+        """
+        self.db = ContainerTestLib(image_name=VARS.IMAGE_NAME, db_type=VARS.DB_TYPE)
+        self.data_dir = tempfile.mkdtemp(prefix="/tmp/psql-replica-restart")
+        ContainerTestLibUtils.commands_to_run(
+            commands_to_run=[
+                f"setfacl -m u:26:-wx {self.data_dir}",
+            ]
+        )
+        self.container_args = [
+            "-e POSTGRESQL_ADMIN_PASSWORD=pass",
+            "-e POSTGRESQL_MASTER_USER=master",
+            "-e POSTGRESQL_MASTER_PASSWORD=master",
+        ]
+
+    def teardown_method(self):
+        """
+        Teardown the test environment.
+        """
+        self.db.cleanup()
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+    def start_replica(self, cid_file_name, primary_cip, volume=True):
+        """
+        Start a replica of the primary at primary_cip.
+        """
+        container_args = self.container_args + [
+            f"--add-host postgresql-master:{primary_cip}",
+            "-e POSTGRESQL_MASTER_IP=postgresql-master",
+        ]
+        if volume:
+            container_args.append(f"-v {self.data_dir}:/var/lib/pgsql/data:Z")
+        return create_and_wait_for_container(
+            db=self.db,
+            cid_file_name=cid_file_name,
+            container_args=container_args,
+            command="run-postgresql-slave",
+        )
+
+    def check_replication(self, primary_cip, replica_cip, value):
+        """
+        Check a row inserted on the primary reaches the replica.
+        """
+        self.db.db_lib.run_sql_command(
+            container_ip=primary_cip,
+            username="master",
+            password="master",
+            database="postgres",
+            sql_cmd=f"-c 'CREATE TABLE IF NOT EXISTS t1 (a integer); INSERT INTO t1 VALUES ({value});'",
+        )
+        sleep(3)
+        output = self.db.db_lib.run_sql_command(
+            container_ip=replica_cip,
+            username="master",
+            password="master",
+            database="postgres",
+            sql_cmd="-At -c 'select * from t1;'",
+        )
+        assert re.search(rf"^{value}$", output, re.MULTILINE), (
+            f"Value {value} not found in REPLICA {replica_cip} for table t1"
+        )
+
+    def test_replica_restart(self):
+        """
+        Test a restarted replica reuses its data directory instead of copying
+        the primary again.
+        """
+        _, master_cip = create_and_wait_for_container(
+            db=self.db,
+            cid_file_name="master-replica-restart",
+            container_args=self.container_args,
+            command="run-postgresql-master",
+        )
+        slave_cid, slave_cip = self.start_replica("slave-first", master_cip)
+        self.check_replication(master_cip, slave_cip, 1)
+        PodmanCLIWrapper.call_podman_command(cmd=f"stop {slave_cid}")
+        PodmanCLIWrapper.call_podman_command(cmd=f"rm {slave_cid}")
+
+        slave_cid, slave_cip = self.start_replica("slave-restarted", master_cip)
+        logs = PodmanCLIWrapper.podman_logs(container_id=slave_cid)
+        assert "Reusing the existing data directory" in logs
+        assert "Initializing PostgreSQL slave" not in logs
+        self.check_replication(master_cip, slave_cip, 2)
+
+    def test_old_primary_rewind(self):
+        """
+        Test the old primary restarted as a replica of the promoted one is
+        rewound instead of copied again.
+        """
+        master_cid, master_cip = create_and_wait_for_container(
+            db=self.db,
+            cid_file_name="master-rewind",
+            container_args=self.container_args
+            + [f"-v {self.data_dir}:/var/lib/pgsql/data:Z"],
+            command="run-postgresql-master",
+        )
+        slave_cid, slave_cip = self.start_replica(
+            "slave-rewind", master_cip, volume=False
+        )
+        self.check_replication(master_cip, slave_cip, 1)
+
+        # Fail over to the replica.
+        PodmanCLIWrapper.call_podman_command(
+            cmd=f"exec {slave_cid} psql -c 'SELECT pg_promote();'",
+        )
+        PodmanCLIWrapper.call_podman_command(cmd=f"stop {master_cid}")
+        PodmanCLIWrapper.call_podman_command(cmd=f"rm {master_cid}")
+
+        old_master_cid, old_master_cip = self.start_replica(
+            "old-master-rewound", slave_cip
+        )
+        logs = PodmanCLIWrapper.podman_logs(container_id=old_master_cid)
+        assert "Rewinding the existing data directory" in logs
+        assert "Initializing PostgreSQL slave" not in logs
+        self.check_replication(slave_cip, old_master_cip, 2)
@@ -51,6 +51,7 @@ class TestPostgreSQLUpgrade:
             ("copy", "empty"),
             ("hardlink", "pagila"),
             ("copy", "pagila"),
+            ("clone", "empty"),
         ],
     )
     def test_upgrade_functionality(self, upgrade_type, datadir):
@@ -84,6 +85,44 @@ class TestPostgreSQLUpgrade:
         self.upgrade_image(upgrade_type=upgrade_type)
         self.upgrade_image(upgrade_type=upgrade_type, bool_test_upgrade=False)
 
+    @pytest.mark.parametrize(
+        "prev_version, settings",
+        [
+            # maintenance_io_concurrency is new in PostgreSQL 13.
+            ("12", ["POSTGRESQL_STORAGE_TYPE=ssd"]),
+            # log_startup_progress_interval, recovery_prefetch and
+            # wal_decode_buffer_size (generated on 15+) are new in PostgreSQL 15.
+            ("13", []),
+        ],
+    )
+    def test_upgrade_new_settings(self, prev_version, settings):
+        """
+        Test the upgrade with settings the previous version does not know,
+        which must not be passed to the old server started by pg_upgrade.
+        """
+        if VARS.OS == "fedora":
+            pytest.skip(
+                "Skip upgrade test on Fedora. Only CentOS Stream and RHELs are supported."
+            )
+        if get_upgrade_path() != prev_version:
+            pytest.skip(
+                f"Skipping for {VARS.OS} and version {VARS.VERSION}. No upgrade from {prev_version}."
+            )
+        self.datadir = "empty"
+        self.registry_image = get_image_id(version=prev_version)
+        if not PodmanCLIWrapper.podman_pull_image(
+            image_name=self.registry_image, loops=3
+        ):
+            pytest.skip(
+                f"{self.registry_image} image not found in registry so skipping upgrade test.."
+            )
+        self.db.image_name = self.registry_image
+        self.create_database_in_prev_version()
+        self.upgrade_image(
+            upgrade_type="copy",
+            container_args=[f"-e {setting}" for setting in settings],
+        )
+
     def create_database_in_prev_version(self):
         """
         Create a database in the old version.
@@ -121,7 +160,12 @@ class TestPostgreSQLUpgrade:
             )
             check_pagila_db(cid=cid_create)
 
-    def upgrade_image(self, upgrade_type: str, bool_test_upgrade: bool = True):
+    def upgrade_image(
+        self,
+        upgrade_type: str,
+        bool_test_upgrade: bool = True,
+        container_args: list[str] | None = None,
+    ):
         """
         Upgrade the image.
         Steps are:
@@ -141,7 +185,7 @@ class TestPostgreSQLUpgrade:
         container_args = [
             f"-e POSTGRESQL_ADMIN_PASSWORD={self.admin_password}",
             f"-v {self.upgrade_volume_dir}:/var/lib/pgsql/data:Z",
-        ]
+        ] + (container_args or [])
         if bool_test_upgrade:
             container_args.append(f"-e POSTGRESQL_UPGRADE={upgrade_type}")
 